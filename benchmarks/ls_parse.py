@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""Time taken to parse ls -la lines, as listed by devices whose find has no -printf, with AndroidFileSystem.ls_to_stat
+and with the regular expression and strptime alone. The lines are the toybox style listings in fixtures/, and both parsers
+are checked to agree on every one of them.
+
+    python3 benchmarks/ls_parse.py --repeat 2000
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import stat
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ADBSync.FileSystems.Android import AndroidFileSystem
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "ls-la-*.txt")
+
+class ListingParser(AndroidFileSystem):
+    """The parsing half of AndroidFileSystem, without an adb shell behind it"""
+    def __init__(self) -> None:
+        pass
+
+    def __del__(self) -> None:
+        pass
+
+    def regex_ls_to_stat(self, line: str):
+        match = self.RE_LS_TO_STAT.fullmatch(line)
+        if match is None:
+            return None
+        match_groupdict = match.groupdict()
+        st_mode = self.LS_PERMISSIONS
+        for s_ifmt in ("S_IFREG", "S_IFBLK", "S_IFCHR", "S_IFDIR", "S_IFIFO", "S_IFLNK", "S_IFSOCK"):
+            if match_groupdict[s_ifmt]:
+                st_mode |= getattr(stat, s_ifmt)
+        st_size = None if match_groupdict["st_size"] is None else int(match_groupdict["st_size"])
+        st_mtime = int(datetime.datetime.strptime(match_groupdict["st_mtime"], "%Y-%m-%d %H:%M").timestamp())
+        return match_groupdict["filename"], os.stat_result((st_mode, 1, 0, 1, -2, -2, st_size, st_mtime, st_mtime, st_mtime))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type = int, default = 500, help = "Times over all the fixture lines. Defaults to 500")
+    args = parser.parse_args()
+
+    lines = []
+    for path in sorted(glob.glob(FIXTURES)):
+        with open(path, "r", encoding = "UTF-8") as f:
+            lines.extend(line for line in f.read().splitlines() if not ListingParser.RE_TOTAL.fullmatch(line))
+    listing_parser = ListingParser()
+
+    for line in lines:
+        filename, stat_object = listing_parser.ls_to_stat(line)
+        expected_filename, expected_stat_object = listing_parser.regex_ls_to_stat(line)
+        if (filename, stat_object.st_mode, stat_object.st_size, stat_object.st_mtime) != (
+            expected_filename, expected_stat_object.st_mode, expected_stat_object.st_size, expected_stat_object.st_mtime
+        ):
+            sys.exit(f"Parsers disagree on {line!r}")
+
+    print(f"lines:                  {len(lines)} from {len(glob.glob(FIXTURES))} listings, {args.repeat} times")
+    for name, parse in (("ls_to_stat", listing_parser.ls_to_stat), ("regex and strptime", listing_parser.regex_ls_to_stat)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for line in lines:
+                parse(line)
+        elapsed = time.perf_counter() - start
+        print(f"{name + ':':<23} {elapsed:.2f} s, {elapsed / (args.repeat * len(lines)) * 1e6:.2f} us per line")
+
+if __name__ == "__main__":
+    main()
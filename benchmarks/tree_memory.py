@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Memory and time taken by the file trees of a large sync: scanning both ends, then FileSyncer.diff_operations gathered
+into a SyncPlan.
+
+Trees are built by FileSystem._get_files_tree over a synthetic in-memory file system, so every name arrives as a new
+string like it would from a real listing. Run with --gc to see what keeping the cyclic garbage collector away from the
+trees, as main() does, saves.
+
+    python3 benchmarks/tree_memory.py --files 1000000
+"""
+
+import argparse
+import gc
+import os
+import stat
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ADBSync import FileSyncer
+from ADBSync.Excludes import ExcludeMatcher
+from ADBSync.Plan import SyncPlan
+from ADBSync.FileSystems.Base import FileSystem
+
+class SyntheticFileSystem(FileSystem):
+    """directories directories of files_per_directory files each, below a root directory"""
+    def __init__(self, directories: int, files_per_directory: int, mtime_offset: int = 0) -> None:
+        super().__init__([])
+        self.directories = directories
+        self.files_per_directory = files_per_directory
+        self.mtime_offset = mtime_offset
+
+    def stat_object(self, mode: int, index: int) -> os.stat_result:
+        mtime = 1600000000 + index + self.mtime_offset
+        return os.stat_result((mode | 0o755, 1, 0, 1, 0, 0, 1000 + index, mtime - 5, mtime, mtime))
+
+    def lstat(self, path: str) -> os.stat_result:
+        return self.stat_object(stat.S_IFDIR, 0)
+
+    def lstat_in_dir(self, path: str):
+        if path == "root":
+            for directory in range(self.directories):
+                yield f"directory {directory}", self.stat_object(stat.S_IFDIR, directory)
+        else:
+            directory = int(path.rsplit(" ", 1)[1])
+            for file in range(self.files_per_directory):
+                yield f"IMG_{directory:05}_{file:05}.jpg", self.stat_object(stat.S_IFREG, directory * self.files_per_directory + file)
+
+    def join(self, base: str, leaf: str) -> str:
+        return f"{base}/{leaf}"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type = int, default = 200000, help = "Files at each end. Defaults to 200000")
+    parser.add_argument("--files-per-directory", type = int, default = 200)
+    parser.add_argument("--gc", action = "store_true", help = "Leave the cyclic garbage collector on, like before")
+    args = parser.parse_args()
+
+    directories = max(1, args.files // args.files_per_directory)
+    # Every file one second newer at the source, so all of them end up in the copy tree
+    fs_source = SyntheticFileSystem(directories, args.files_per_directory)
+    fs_destination = SyntheticFileSystem(directories, args.files_per_directory, mtime_offset = -1)
+
+    gc_time = 0.0
+    gc_start = 0.0
+    def gc_callback(phase: str, info: dict) -> None:
+        nonlocal gc_time, gc_start
+        if phase == "start":
+            gc_start = time.perf_counter()
+        else:
+            gc_time += time.perf_counter() - gc_start
+    gc.callbacks.append(gc_callback)
+    if not args.gc:
+        gc.disable()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree_source = fs_source.get_files_tree("root")
+    tree_destination = fs_destination.get_files_tree("root")
+    scan_time = time.perf_counter() - start
+    scan_memory = tracemalloc.get_traced_memory()[0]
+
+    def operations():
+        return FileSyncer.diff_operations(tree_source, tree_destination, "root", "root", ExcludeMatcher([]), fs_source.join, fs_destination.join)
+
+    # The diff on its own, so that what building the plan adds shows
+    start = time.perf_counter()
+    for _ in operations():
+        pass
+    diff_time = time.perf_counter() - start
+
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    plan = SyncPlan.from_operations(operations())
+    plan_time = time.perf_counter() - start
+    plan_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"files at each end:      {directories * args.files_per_directory}")
+    leaf = fs_source.stat_to_tree_leaf(fs_source.stat_object(stat.S_IFREG, 1))
+    leaf_size = sys.getsizeof(leaf)
+    leaf_tuple_size = sys.getsizeof(tuple(leaf)) + sum(sys.getsizeof(field) for field in leaf)
+    print(f"bytes per leaf:         {leaf_size} as TreeLeaf, {leaf_tuple_size} as a tuple of ints")
+    print(f"cyclic gc during build: {args.gc}")
+    print(f"scan:                   {scan_time:.2f} s, {scan_memory / 2 ** 20:.1f} MiB")
+    print(f"diff alone:             {diff_time:.2f} s")
+    print(f"diff into plan:         {plan_time:.2f} s, {(plan_memory - scan_memory) / 2 ** 20:.1f} MiB retained")
+    print(f"peak:                   {peak_memory / 2 ** 20:.1f} MiB")
+    print(f"gc pauses:              {gc_time:.2f} s")
+
+if __name__ == "__main__":
+    main()
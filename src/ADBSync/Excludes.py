@@ -0,0 +1,78 @@
+"""--exclude patterns compiled into one matcher"""
+
+from typing import Callable, Iterable, List, Tuple
+import fnmatch
+import os
+import posixpath
+import re
+
+class ExcludeMatcher():
+    """Whether fnmatch.fnmatch(path, pattern) holds for any of the patterns, without trying them one at a time.
+    Patterns without wildcards are looked up in a set, those that are a literal followed or preceded by *s become one
+    startswith / endswith call, and everything else goes into a single regular expression"""
+    RE_MAGIC = re.compile(r"[*?[]")
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.patterns = list(patterns)
+        self.literals = set()
+        prefixes = []
+        suffixes = []
+        others = []
+        for pattern in self.patterns:
+            pattern = os.path.normcase(pattern) # like fnmatch.fnmatch does
+            if not self.RE_MAGIC.search(pattern):
+                self.literals.add(pattern)
+            elif pattern.endswith("*") and not self.RE_MAGIC.search(pattern.rstrip("*")):
+                prefixes.append(pattern.rstrip("*"))
+            elif pattern.startswith("*") and not self.RE_MAGIC.search(pattern.lstrip("*")):
+                suffixes.append(pattern.lstrip("*"))
+            else:
+                others.append(pattern)
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+        self.regex_match = re.compile("|".join(fnmatch.translate(pattern) for pattern in others)).match if others else None
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def match(self, path: str) -> bool:
+        if not self.patterns:
+            return False
+        path = os.path.normcase(path)
+        return (
+            path in self.literals
+            or (bool(self.prefixes) and path.startswith(self.prefixes))
+            or (bool(self.suffixes) and path.endswith(self.suffixes))
+            or (self.regex_match is not None and self.regex_match(path) is not None)
+        )
+
+class TreeExclude():
+    """For FileSystem.get_files_tree: whether the directory the given names lead to from a tree's root is excluded, going by
+    where it ends up at the destination"""
+    def __init__(self, patterns: Iterable[str], root: str, join: Callable[[str, str], str], normpath: Callable[[str], str]) -> None:
+        self.patterns = list(patterns)
+        self.root = root
+        self.join = join
+        self.matcher = ExcludeMatcher(normpath(join(root, pattern)) for pattern in self.patterns)
+
+    def __call__(self, names: Tuple[str, ...]) -> bool:
+        path = self.root
+        for name in names:
+            path = self.join(path, name)
+        return self.matcher.match(path)
+
+    def relative_patterns(self) -> List[str]:
+        """The patterns, normalized, that select the same paths below any other root as they do below this one. Those
+        that don't (absolute, going up with .., or with [ ] classes or \\ escapes that other fnmatch implementations read
+        differently) are left to __call__"""
+        if ExcludeMatcher.RE_MAGIC.search(self.root):
+            return []
+        relative_patterns = []
+        for pattern in self.patterns:
+            if "[" in pattern or "\\" in pattern or pattern.startswith("/"):
+                continue
+            pattern = posixpath.normpath(pattern)
+            if pattern == "." or pattern == ".." or pattern.startswith("../"):
+                continue
+            relative_patterns.append(pattern)
+        return relative_patterns
@@ -1,14 +1,59 @@
-from typing import Iterable, Iterator, List, NoReturn, Tuple
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, NoReturn, Optional, Set, Tuple
+from concurrent.futures import Future
 import logging
 import os
+import errno
 import re
 import stat
 import datetime
 import subprocess
-
-from ..SAOLogging import logging_fatal
-
-from .Base import FileSystem
+import codecs
+import collections
+import contextlib
+import threading
+import time
+import functools
+import posixpath
+import shlex
+import tarfile
+
+from ..Excludes import ExcludeMatcher, TreeExclude
+from ..SAOLogging import logging_fatal, perror
+
+from .Base import FileSystem, TransferResult, TransferScheduler, TreeLeaf
+from . import Cache
+from . import Compression
+
+class AdbShellReply():
+    """Output of one command sent to the persistent adb shell"""
+    def __init__(self, tag: int, separator: str) -> None:
+        self.tag = tag
+        self.separator = separator
+        self.records: Deque[str] = collections.deque() # read ahead of the consumer, see adb_shell_detach_reply
+        self.finished = False
+        self.exit_status: Optional[int] = None
+        self.size_in = 0 # characters read, end of command marker included
+        # For --trace
+        self.commands: Optional[List[str]] = None
+        self.sent = 0.0
+        self.size_out = 0
+        self.round_trip_commands = 1
+
+    def start_trace(self, commands: List[str], size_out: int, round_trip_commands: int) -> None:
+        self.commands = commands
+        self.sent = time.time()
+        self.size_out = size_out
+        self.round_trip_commands = round_trip_commands
+
+class LsStat():
+    """What an ls -la line tells of an entry, standing in for os.stat_result. atime is not listed, so it is the mtime"""
+    __slots__ = ("st_mode", "st_size", "st_atime", "st_mtime")
+
+    def __init__(self, st_mode: int, st_size: Optional[int], st_mtime: int) -> None:
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_atime = st_mtime
+        self.st_mtime = st_mtime
 
 class AndroidFileSystem(FileSystem):
     RE_TESTCONNECTION_NO_DEVICE = re.compile("^adb\\: no devices/emulators found$")
@@ -51,10 +96,18 @@ class AndroidFileSystem(FileSystem):
         (?(S_IFLNK) .* | (?P<filename> .*))
         $""", re.DOTALL | re.VERBOSE)
 
+    RE_LS_MODE_FILE_OR_DIRECTORY = re.compile("[-d][-r][-w][-xsS][-r][-w][-xsS][-r][-w][-xtT]")
+    LS_PERMISSIONS = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH # 755, what ls gives isn't kept
+    LS_MINUTES = {f"{hours:02}:{minutes:02}": hours * 3600 + minutes * 60 for hours in range(24) for minutes in range(60)}
+
     RE_NO_SUCH_FILE = re.compile("^.*: No such file or directory$")
     RE_LS_NOT_A_DIRECTORY = re.compile("ls: .*: Not a directory$")
+    RE_NOT_A_DIRECTORY = re.compile("^.*: Not a directory$")
     RE_TOTAL = re.compile("^total \\d+$")
 
+    RE_MD5SUM = re.compile("^(?P<checksum>[0-9a-f]{32})  (?P<path>.*)$", re.DOTALL)
+    RE_STAT_SIZE_MTIME = re.compile("^(?P<size>\\d+) (?P<mtime>\\d+) (?P<path>.*)$", re.DOTALL)
+
     RE_REALPATH_NO_SUCH_FILE = re.compile("^realpath: .*: No such file or directory$")
     RE_REALPATH_NOT_A_DIRECTORY = re.compile("^realpath: .*: Not a directory$")
 
@@ -68,10 +121,46 @@ class AndroidFileSystem(FileSystem):
     ]
 
     ADBSYNC_END_OF_COMMAND = "ADBSYNC END OF COMMAND"
-
-    def __init__(self, adb_arguments: List[str], adb_encoding: str) -> None:
+    RE_END_OF_COMMAND = re.compile(f"(?:(?P<output>.*)\\n)?{re.escape(ADBSYNC_END_OF_COMMAND)} (?P<tag>\\d+) (?P<exit_status>\\d+)", re.DOTALL)
+    ADB_SHELL_READ_SIZE = 1 << 16
+    ADB_SHELL_QUEUE_SIZE = 1024 # commands per pipelined write at most
+    DEFAULT_ARG_MAX = 131072 # if getconf is missing
+    UNORDERED_PATH_COMMANDS = {"touch"} # whose batches may run in any order relative to each other
+
+    # One NUL-terminated record per entry: type, size, atime, mtime, path relative to the starting point.
+    # The path comes last so that tabs in filenames survive a maxsplit
+    FIND_PRINTF_FORMAT = "%y\\t%s\\t%A@\\t%T@\\t%P\\0"
+    FIND_PRINTF_FORMAT_FULL_PATH = "%y\\t%s\\t%A@\\t%T@\\t%p\\0" # for several starting points
+    FIND_TYPE_TO_S_IFMT = {
+        "f": stat.S_IFREG,
+        "d": stat.S_IFDIR,
+        "l": stat.S_IFLNK,
+        "b": stat.S_IFBLK,
+        "c": stat.S_IFCHR,
+        "p": stat.S_IFIFO,
+        "s": stat.S_IFSOCK
+    }
+
+    def __init__(self, adb_arguments: List[str], adb_encoding: str, snapshot_dir: Optional[str] = None) -> None:
         super().__init__(adb_arguments)
         self.adb_encoding = adb_encoding
+        self.snapshot_dir = snapshot_dir # for --incremental
+        self.snapshot: Optional[Tuple[str, bool, int, Dict[str, list]]] = None # tree path, follow links, scan time, directories
+        self.device_serial: Optional[str] = None
+        self.find_printf_supported: Optional[bool] = None # probed on first tree scan
+        self.adb_shell_reply: Optional[AdbShellReply] = None
+        self.adb_shell_tag = 0
+        self.adb_shell_queued: List[Tuple[List[str], AdbShellReply, Future, Optional[Callable[[List[str], int], None]]]] = []
+        self.adb_shell_pipeline_depth = 0
+        self.adb_shell_batches: Dict[Tuple[str, ...], List[str]] = {}
+        self.adb_shell_batch_sizes: Dict[Tuple[str, ...], int] = {}
+        self.arg_max: Optional[int] = None # probed on first batch
+        self.tar_supported: Optional[bool] = None # probed on first tar transfer
+        self.compression_codecs: Optional[Tuple[Set[str], Set[str]]] = None
+        self.adb_shell_buffer = ""
+        self.adb_shell_buffer_position = 0
+        self.adb_shell_decoder = codecs.getincrementaldecoder(self.adb_encoding)()
+        self.counters.count(subprocesses = 1)
         self.proc_adb_shell = subprocess.Popen(
             self.adb_arguments + ["shell"],
             stdin = subprocess.PIPE,
@@ -83,26 +172,203 @@ class AndroidFileSystem(FileSystem):
         self.proc_adb_shell.stdin.close()
         self.proc_adb_shell.wait()
 
-    def adb_shell(self, commands: List[str]) -> Iterator[str]:
-        self.proc_adb_shell.stdin.write(" ".join(commands).encode(self.adb_encoding))
-        self.proc_adb_shell.stdin.write("\n".encode(self.adb_encoding))
-        self.proc_adb_shell.stdin.write(f"echo \"{self.ADBSYNC_END_OF_COMMAND}\"\n".encode(self.adb_encoding))
+    def adb_shell_command(self, commands: List[str], reply: AdbShellReply) -> bytes:
+        """The command line followed by its tagged end of command marker, which also carries the exit status"""
+        if reply.separator == "\n":
+            end_of_command = f"echo \"{self.ADBSYNC_END_OF_COMMAND} {reply.tag} $?\""
+        else:
+            end_of_command = f"printf '%s\\0' \"{self.ADBSYNC_END_OF_COMMAND} {reply.tag} $?\""
+        return f"{' '.join(commands)}\n{end_of_command}\n".encode(self.adb_encoding)
+
+    def adb_shell_new_reply(self, separator: str = "\n") -> AdbShellReply:
+        self.adb_shell_tag += 1
+        return AdbShellReply(self.adb_shell_tag, separator)
+
+    def adb_shell(self, commands: List[str], separator: str = "\n") -> Iterator[str]:
+        """Run a command in the persistent adb shell and yield its output records as they arrive.
+        separator is "\\n" for line based output or "\\0" for NUL-terminated records (eg find -printf)"""
+        self.adb_shell_flush()
+        self.adb_shell_detach_reply()
+
+        reply = self.adb_shell_reply = self.adb_shell_new_reply(separator)
+        self.counters.count(shell_round_trips = 1, shell_commands = 1)
+        command = self.adb_shell_command(commands, reply)
+        if self.trace is not None:
+            reply.start_trace(commands, len(command), 1)
+        self.proc_adb_shell.stdin.write(command)
         self.proc_adb_shell.stdin.flush()
 
-        lines_to_yield: List[str] = []
-        while adb_line := self.proc_adb_shell.stdout.readline():
-            adb_line = adb_line.decode(self.adb_encoding).rstrip("\r\n")
-            if adb_line == self.ADBSYNC_END_OF_COMMAND:
-                break
-            else:
-                lines_to_yield.append(adb_line)
-        for line in lines_to_yield:
-            yield line
+        try:
+            while True:
+                if reply.records:
+                    yield reply.records.popleft()
+                elif reply.finished:
+                    break
+                elif (record := self.adb_shell_read_record(reply)) is not None:
+                    yield record
+        finally:
+            # Stopped early (eg realpath returning its first line); the rest must not leak into the next command
+            while not reply.finished:
+                self.adb_shell_read_record(reply)
+
+    def adb_shell_queue(self,
+        commands: List[str],
+        callback: Optional[Callable[[List[str], int], None]] = None,
+        separator: str = "\n"
+        ) -> Future:
+        """Queue a command to be sent along with others by adb_shell_flush instead of waiting for each reply in turn.
+        The returned future resolves to the output lines and exit status; callback, if given, is called with them as well"""
+        future: Future = Future()
+        self.adb_shell_queued.append((commands, self.adb_shell_new_reply(separator), future, callback))
+        if len(self.adb_shell_queued) >= self.ADB_SHELL_QUEUE_SIZE:
+            self.adb_shell_flush()
+        return future
+
+    def adb_shell_flush(self) -> None:
+        """Send all queued commands in one write and hand each reply back to its future / callback"""
+        while self.adb_shell_batches:
+            self.adb_shell_queue_batch(next(iter(self.adb_shell_batches)))
+        if not self.adb_shell_queued:
+            return
+        queued, self.adb_shell_queued = self.adb_shell_queued, []
+        self.adb_shell_detach_reply()
+
+        # Write from another thread; a batch whose replies fill the stdout pipe would otherwise deadlock against us
+        batch_commands = [self.adb_shell_command(commands, reply) for commands, reply, _, _ in queued]
+        if self.trace is not None:
+            for (commands, reply, _, _), command in zip(queued, batch_commands):
+                reply.start_trace(commands, len(command), len(queued))
+        batch = b"".join(batch_commands)
+        self.counters.count(shell_round_trips = 1, shell_commands = len(queued))
+        writer = threading.Thread(target = self.adb_shell_write, args = (batch,), daemon = True)
+        writer.start()
+        for _, reply, future, callback in queued:
+            lines: List[str] = []
+            while not reply.finished:
+                if (record := self.adb_shell_read_record(reply)) is not None:
+                    lines.append(record)
+            lines.extend(reply.records)
+            future.set_result((lines, reply.exit_status))
+            if callback is not None:
+                callback(lines, reply.exit_status)
+        writer.join()
+
+    def adb_shell_write(self, data: bytes) -> None:
+        self.proc_adb_shell.stdin.write(data)
+        self.proc_adb_shell.stdin.flush()
+
+    def flush(self) -> None:
+        self.adb_shell_flush()
+
+    @contextlib.contextmanager
+    def pipelined(self) -> Iterator[None]:
+        self.adb_shell_pipeline_depth += 1
+        try:
+            yield
+        finally:
+            self.adb_shell_pipeline_depth -= 1
+        if not self.adb_shell_pipeline_depth:
+            self.adb_shell_flush()
+
+    def adb_shell_path_command(self, commands: List[str], path: str) -> None:
+        """Run a command on a path that prints nothing when it succeeds. While pipelined, paths given to the same command
+        (rm, mkdir -p, touch with the same times...) are collected into multi-argument commands sized to the device's ARG_MAX.
+        Only consecutive paths are collected, so that eg rm DIR/FILE still runs before rm -r DIR; touch batches are the
+        exception, their order doesn't matter"""
+        escaped_path = self.escape_path(path)
+        if not self.adb_shell_pipeline_depth:
+            for line in self.adb_shell(commands + [escaped_path]):
+                self.line_not_captured(line)
+            return
+
+        argument_size_limit = self.argument_size_limit() # first, as probing flushes the open batches
+        key = tuple(commands)
+        for open_key in list(self.adb_shell_batches):
+            if open_key != key and not (open_key[0] in self.UNORDERED_PATH_COMMANDS and key[0] in self.UNORDERED_PATH_COMMANDS):
+                self.adb_shell_queue_batch(open_key)
+        argument_size = len(escaped_path.encode(self.adb_encoding)) + 1
+        if key in self.adb_shell_batches and self.adb_shell_batch_sizes[key] + argument_size > argument_size_limit:
+            self.adb_shell_queue_batch(key)
+        if key not in self.adb_shell_batches:
+            self.adb_shell_batches[key] = []
+            self.adb_shell_batch_sizes[key] = len(" ".join(commands).encode(self.adb_encoding))
+        self.adb_shell_batches[key].append(escaped_path)
+        self.adb_shell_batch_sizes[key] += argument_size
+
+    def adb_shell_queue_batch(self, key: Tuple[str, ...]) -> None:
+        escaped_paths = self.adb_shell_batches.pop(key)
+        del self.adb_shell_batch_sizes[key]
+        self.adb_shell_queue(list(key) + escaped_paths, callback = self.batch_lines_not_captured)
+
+    def argument_size_limit(self) -> int:
+        if self.arg_max is None:
+            try:
+                self.arg_max = int(next(self.adb_shell(["getconf", "ARG_MAX"])))
+            except (StopIteration, ValueError):
+                self.arg_max = self.DEFAULT_ARG_MAX
+            logging.debug(f"Device ARG_MAX {self.arg_max}")
+        return self.arg_max // 2 # the environment shares ARG_MAX with the arguments
+
+    def adb_shell_read_record(self, reply: AdbShellReply) -> Optional[str]:
+        """Read the next record of the reply currently being received. Returns None once its end of command marker is read"""
+        separator = reply.separator
+        while (index := self.adb_shell_buffer.find(separator, self.adb_shell_buffer_position)) == -1:
+            chunk = self.proc_adb_shell.stdout.read1(self.ADB_SHELL_READ_SIZE)
+            if not chunk:
+                # adb went away; hand out what is left like readline would
+                reply.finished = True
+                record = self.adb_shell_buffer[self.adb_shell_buffer_position:]
+                self.adb_shell_buffer, self.adb_shell_buffer_position = "", 0
+                reply.size_in += len(record)
+                if reply.commands is not None:
+                    self.adb_shell_trace_reply(reply)
+                return record or None
+            self.adb_shell_buffer = self.adb_shell_buffer[self.adb_shell_buffer_position:] + self.adb_shell_decoder.decode(chunk)
+            self.adb_shell_buffer_position = 0
+        record = self.adb_shell_buffer[self.adb_shell_buffer_position:index]
+        reply.size_in += index + len(separator) - self.adb_shell_buffer_position
+        self.adb_shell_buffer_position = index + len(separator)
+        if separator == "\n":
+            record = record.rstrip("\r")
+
+        if self.ADBSYNC_END_OF_COMMAND in record and (match := self.RE_END_OF_COMMAND.fullmatch(record)):
+            if int(match["tag"]) != reply.tag:
+                logging_fatal(f"Out of sync with adb shell: expected reply {reply.tag}, got {match['tag']}")
+            reply.finished = True
+            reply.exit_status = int(match["exit_status"])
+            if match["output"] is not None:
+                # Unterminated output (eg an error message) right before the marker
+                reply.records.append(match["output"])
+            if reply.commands is not None:
+                self.adb_shell_trace_reply(reply)
+            return None
+        return record
+
+    def adb_shell_trace_reply(self, reply: AdbShellReply) -> None:
+        self.trace.shell_command(reply.commands, reply.sent, time.time(), reply.size_out, reply.size_in, reply.exit_status, reply.round_trip_commands)
+
+    def adb_shell_detach_reply(self) -> None:
+        """Buffer whatever is left of the previous reply so that a new command can be sent while it is still being iterated,
+        eg the per directory walker listing a subdirectory halfway through its parent's listing"""
+        reply = self.adb_shell_reply
+        if reply is None:
+            return
+        while not reply.finished:
+            if (record := self.adb_shell_read_record(reply)) is not None:
+                reply.records.append(record)
+        self.adb_shell_reply = None
 
     def line_not_captured(self, line: str) -> NoReturn:
         logging.critical("ADB line not captured")
         logging_fatal(line)
 
+    def batch_lines_not_captured(self, lines: List[str], exit_status: int) -> None:
+        # A multi-argument command carries on past paths it fails on; report all of them before giving up
+        for line in lines:
+            logging.error(line)
+        if lines:
+            logging_fatal("ADB lines not captured")
+
     def escape_path(self, path: str) -> str:
         for replacement in self.ESCAPE_PATH_REPLACEMENTS:
             path = path.replace(*replacement)
@@ -117,14 +383,24 @@ class AndroidFileSystem(FileSystem):
 
             raise BrokenPipeError
 
-    def ls_to_stat(self, line: str) -> Tuple[str, os.stat_result]:
+    def ls_to_stat(self, line: str) -> Tuple[Optional[str], LsStat]:
+        # Nearly every line is a file or directory with all columns present, which splitting takes apart much faster
+        # than RE_LS_TO_STAT. The filename is only taken from the split if it is preceded by a single space, as ls prints
+        # it; otherwise it may have started with whitespace
+        fields = line.split(None, 7)
+        if len(fields) == 8 and fields[1].isdecimal() and fields[4].isdecimal() and line[-len(fields[7]) - 2] != " ":
+            st_mode = self.ls_file_or_directory_mode(fields[0])
+            st_mtime = self.ls_time_to_epoch(fields[5], fields[6])
+            if st_mode is not None and st_mtime is not None:
+                return fields[7], LsStat(st_mode, None if stat.S_ISDIR(st_mode) else int(fields[4]), st_mtime)
+
         if self.RE_NO_SUCH_FILE.fullmatch(line):
             raise FileNotFoundError
         elif self.RE_LS_NOT_A_DIRECTORY.fullmatch(line):
             raise NotADirectoryError
         elif match := self.RE_LS_TO_STAT.fullmatch(line):
             match_groupdict = match.groupdict()
-            st_mode = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH # 755
+            st_mode = self.LS_PERMISSIONS
             if match_groupdict['S_IFREG']:
                 st_mode |= stat.S_IFREG
             if match_groupdict['S_IFBLK']:
@@ -140,35 +416,284 @@ class AndroidFileSystem(FileSystem):
             if match_groupdict['S_IFSOCK']:
                 st_mode |= stat.S_IFSOCK
             st_size = None if match_groupdict["st_size"] is None else int(match_groupdict["st_size"])
-            st_mtime = int(datetime.datetime.strptime(match_groupdict["st_mtime"], "%Y-%m-%d %H:%M").timestamp())
-
-            # Fill the rest with dummy values.
-            st_ino = 1
-            st_rdev = 0
-            st_nlink = 1
-            st_uid = -2  # Nobody.
-            st_gid = -2  # Nobody.
-            st_atime = st_ctime = st_mtime
-
-            return match_groupdict["filename"], os.stat_result((st_mode, st_ino, st_rdev, st_nlink, st_uid, st_gid, st_size, st_atime, st_mtime, st_ctime))
+            st_mtime = self.ls_time_to_epoch(*match_groupdict["st_mtime"].split(" "))
+            if st_mtime is None:
+                st_mtime = self.ls_minute_to_epoch(match_groupdict["st_mtime"]) # raises ValueError
+            return match_groupdict["filename"], LsStat(st_mode, st_size, st_mtime)
         else:
             self.line_not_captured(line)
 
+    @classmethod
+    @functools.lru_cache(maxsize = None)
+    def ls_file_or_directory_mode(cls, mode: str) -> Optional[int]:
+        """st_mode for an ls mode string of a file or directory, None for anything else. Listings have few distinct ones"""
+        if not cls.RE_LS_MODE_FILE_OR_DIRECTORY.fullmatch(mode):
+            return None
+        return (stat.S_IFDIR if mode[0] == "d" else stat.S_IFREG) | cls.LS_PERMISSIONS
+
+    @classmethod
+    def ls_time_to_epoch(cls, date: str, time: str) -> Optional[int]:
+        """The epoch time of ls's YYYY-MM-DD and HH:MM in local time, or None if they are not that"""
+        seconds = cls.LS_MINUTES.get(time)
+        day = cls.ls_date_to_epoch(date)
+        if seconds is None or day is None:
+            return None
+        if day[1]:
+            return day[0] + seconds
+        # A daylight saving time change that day, so not every minute is as far from midnight as the clock says
+        return cls.ls_minute_to_epoch(f"{date} {time}")
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 4096)
+    def ls_minute_to_epoch(date_time: str) -> int:
+        return int(datetime.datetime.strptime(date_time, "%Y-%m-%d %H:%M").timestamp())
+
+    @staticmethod
+    @functools.lru_cache(maxsize = None)
+    def ls_date_to_epoch(date: str) -> Optional[Tuple[int, bool]]:
+        """The epoch time of local midnight starting an ls YYYY-MM-DD, and whether that day is 24 hours long"""
+        if len(date) != 10 or date[4] != "-" or date[7] != "-" or not date.isascii() or not date.replace("-", "").isdigit():
+            return None
+        try:
+            midnight = datetime.datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            return None
+        start = midnight.timestamp()
+        end = (midnight + datetime.timedelta(days = 1)).timestamp()
+        return int(start), end - start == 24 * 60 * 60
+
+    def find_to_stat(self, record: str) -> Optional[Tuple[str, os.stat_result]]:
+        """Parse one FIND_PRINTF_FORMAT record. Returns None if the record is not in that format"""
+        fields = record.split("\t", 4)
+        if len(fields) != 5 or fields[0] not in self.FIND_TYPE_TO_S_IFMT:
+            return None
+        find_type, st_size, st_atime, st_mtime, relative_path = fields
+        try:
+            st_size = int(st_size)
+            st_atime = int(float(st_atime))
+            st_mtime = int(float(st_mtime))
+        except ValueError:
+            return None
+        st_mode = self.FIND_TYPE_TO_S_IFMT[find_type] | stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH # 755
+
+        # Fill the rest with dummy values like ls_to_stat
+        return relative_path, os.stat_result((st_mode, 1, 0, 1, -2, -2, st_size, st_atime, st_mtime, st_mtime))
+
+    def find_prune_arguments(self, tree_path: str, exclude: Optional[TreeExclude]) -> List[str]:
+        """find predicates to follow -printf with, so that excluded directories are printed but not descended into.
+        What can't be put this way is still dropped by add_find_record"""
+        if exclude is None or ExcludeMatcher.RE_MAGIC.search(tree_path):
+            return []
+        prefix = tree_path.rstrip("/") + "/"
+        arguments = []
+        for pattern in exclude.relative_patterns():
+            arguments += ["-o" if arguments else "\\(", "-path", shlex.quote(prefix + pattern)]
+        if not arguments:
+            return []
+        return arguments + ["\\)", "-prune"]
+
+    def find_printf(self, path: str, follow_links: bool = False, exclude: Optional[TreeExclude] = None) -> Iterator[Tuple[str, os.stat_result]]:
+        commands = ["find"]
+        if follow_links:
+            commands.append("-L")
+        commands.append(self.escape_path(path))
+        commands += ["-printf", f"'{self.FIND_PRINTF_FORMAT}'"]
+        commands += self.find_prune_arguments(path, exclude)
+
+        for record in self.adb_shell(commands, separator = "\0"):
+            if (find_stat := self.find_to_stat(record)) is None:
+                # stderr is interleaved with the records, eg "find: ...: Permission denied"
+                self.line_not_captured(record)
+            yield find_stat
+
+    def probe_find_printf(self) -> bool:
+        """Check once per session whether the device's find understands FIND_PRINTF_FORMAT (not all toybox builds do)"""
+        if self.find_printf_supported is None:
+            records = list(self.adb_shell(["find", "/", "-maxdepth", "0", "-printf", f"'{self.FIND_PRINTF_FORMAT}'"], separator = "\0"))
+            self.find_printf_supported = len(records) == 1 and self.find_to_stat(records[0]) is not None
+            if not self.find_printf_supported:
+                logging.debug("find -printf not supported on device, listing one directory at a time with ls")
+                self.timestamp_resolution = 60 # ls -la prints minutes
+        return self.find_printf_supported
+
+    def _get_files_tree(self,
+        tree_path: str,
+        tree_path_stat: os.stat_result,
+        follow_links: bool = False,
+        exclude: Optional[TreeExclude] = None,
+        names: Tuple[str, ...] = ()
+        ):
+        # Fetch the whole subtree in one round trip instead of one ls per directory
+        if not stat.S_ISDIR(tree_path_stat.st_mode) or not self.probe_find_printf():
+            return super()._get_files_tree(tree_path, tree_path_stat, follow_links = follow_links, exclude = exclude, names = names)
+
+        scan_time = None
+        previous_snapshot = None
+        if self.snapshot_dir is not None:
+            try:
+                scan_time = int(next(self.adb_shell(["date", "+%s"])))
+            except (StopIteration, ValueError):
+                logging.warning("Cannot read the device's time, listing everything without saving a snapshot")
+            else:
+                previous_snapshot = Cache.load_snapshot(self.snapshot_path(tree_path, follow_links))
+
+        trees_by_relative_path: Dict[str, dict] = {}
+        if previous_snapshot is None or not self.incremental_scan(tree_path, follow_links, *previous_snapshot, trees_by_relative_path, exclude = exclude):
+            trees_by_relative_path.clear()
+            for relative_path, stat_object in self.find_printf(tree_path, follow_links = follow_links, exclude = exclude):
+                self.add_find_record(tree_path, trees_by_relative_path, relative_path, stat_object, follow_links, exclude = exclude)
+
+        if scan_time is not None:
+            # Direct children only; subdirectories have entries of their own
+            directories = {
+                relative_path: [tree["."].mtime, {filename: child for filename, child in tree.items() if filename != "." and not isinstance(child, dict)}]
+                for relative_path, tree in trees_by_relative_path.items()
+            }
+            self.snapshot = (tree_path, follow_links, scan_time, directories)
+        return trees_by_relative_path[""]
+
+    def add_find_record(self,
+        tree_path: str,
+        trees_by_relative_path: Dict[str, dict],
+        relative_path: str,
+        stat_object: os.stat_result,
+        follow_links: bool,
+        exclude: Optional[TreeExclude] = None
+        ) -> None:
+        if not relative_path:
+            trees_by_relative_path[""] = {".": self.stat_to_tree_leaf(stat_object)}
+            return
+        relative_path_head, filename = self.split(relative_path)
+        parent_tree = trees_by_relative_path.get(relative_path_head)
+        if parent_tree is None:
+            return # below an excluded directory
+        if stat.S_ISLNK(stat_object.st_mode):
+            # find -L only reports symlinks it could not follow
+            if follow_links:
+                perror(f"Skipping symlink {self.join(tree_path, relative_path)}", FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT)))
+            else:
+                logging.warning(f"Ignoring symlink {self.join(tree_path, relative_path)}")
+            parent_tree[filename] = None
+        elif stat.S_ISDIR(stat_object.st_mode):
+            parent_tree[filename] = {".": self.stat_to_tree_leaf(stat_object)}
+            if exclude is None or not exclude(tuple(relative_path.split("/"))):
+                trees_by_relative_path[relative_path] = parent_tree[filename]
+        elif stat.S_ISREG(stat_object.st_mode):
+            parent_tree[filename] = self.stat_to_tree_leaf(stat_object)
+        else:
+            raise NotImplementedError
+
+    def incremental_scan(self,
+        tree_path: str,
+        follow_links: bool,
+        previous_scan_time: int,
+        previous_directories: Dict[str, list],
+        trees_by_relative_path: Dict[str, dict],
+        exclude: Optional[TreeExclude] = None
+        ) -> bool:
+        """Build the tree from the previous --incremental snapshot, listing only the directories whose mtime changed since.
+        Files changed in place don't touch their directory's mtime, so those modified since the previous scan are listed too.
+        Returns False if the device's find can't do this, in which case the caller lists everything"""
+        find_commands = ["find"]
+        if follow_links:
+            find_commands.append("-L")
+
+        # Every directory and any other file modified since the previous scan; the second of margin covers the scan itself
+        records = []
+        commands = find_commands + [self.escape_path(tree_path), "\\(", "-type", "d", "-o", "-newermt", f"@{previous_scan_time - 1}", "\\)", "-printf", f"'{self.FIND_PRINTF_FORMAT}'"]
+        commands += self.find_prune_arguments(tree_path, exclude)
+        for record in self.adb_shell(commands, separator = "\0"):
+            if (find_stat := self.find_to_stat(record)) is None:
+                logging.warning(f"Incremental scan not possible, listing everything: {record}")
+                return False
+            records.append(find_stat)
+        for relative_path, stat_object in records:
+            self.add_find_record(tree_path, trees_by_relative_path, relative_path, stat_object, follow_links, exclude = exclude)
+
+        relative_paths_to_list = []
+        for relative_path, tree in trees_by_relative_path.items():
+            previous_directory = previous_directories.get(relative_path)
+            if previous_directory is None or previous_directory[0] != tree["."].mtime:
+                relative_paths_to_list.append(relative_path)
+                continue
+            for filename, child in previous_directory[1].items():
+                tree.setdefault(filename, child)
+        logging.debug(f"Incremental scan: {len(relative_paths_to_list)} of {len(trees_by_relative_path)} directories changed")
+
+        # The files directly in changed directories, as many directories per find as ARG_MAX allows
+        futures: List[Future] = []
+
+        def queue_listing(escaped_paths: List[str]) -> None:
+            futures.append(self.adb_shell_queue(
+                find_commands + escaped_paths + ["-mindepth", "1", "-maxdepth", "1", "!", "-type", "d", "-printf", f"'{self.FIND_PRINTF_FORMAT_FULL_PATH}'"],
+                separator = "\0"
+            ))
+
+        with self.pipelined():
+            escaped_paths: List[str] = []
+            escaped_paths_size = 0
+            for relative_path in relative_paths_to_list:
+                escaped_path = self.escape_path(self.join(tree_path, relative_path) if relative_path else tree_path)
+                argument_size = len(escaped_path.encode(self.adb_encoding)) + 1
+                if escaped_paths and escaped_paths_size + argument_size > self.argument_size_limit():
+                    queue_listing(escaped_paths)
+                    escaped_paths = []
+                    escaped_paths_size = 0
+                escaped_paths.append(escaped_path)
+                escaped_paths_size += argument_size
+            if escaped_paths:
+                queue_listing(escaped_paths)
+
+        prefix = tree_path.rstrip("/") + "/"
+        for future in futures:
+            records, _ = future.result()
+            for record in records:
+                if (find_stat := self.find_to_stat(record)) is None or not find_stat[0].startswith(prefix):
+                    self.line_not_captured(record)
+                path, stat_object = find_stat
+                self.add_find_record(tree_path, trees_by_relative_path, path[len(prefix):], stat_object, follow_links, exclude = exclude)
+        return True
+
+    def snapshot_path(self, tree_path: str, follow_links: bool) -> str:
+        if self.device_serial is None:
+            self.device_serial = next(self.adb_shell(["getprop", "ro.serialno"]), "")
+        return Cache.snapshot_path(self.snapshot_dir, [self.device_serial, tree_path, str(follow_links)])
+
+    def save_snapshot(self, changed_directories: Iterable[str]) -> None:
+        """Store the last tree scan for the next --incremental run. Directories this run changed the contents of are
+        marked to be listed again, their mtimes having moved past what the scan saw"""
+        if self.snapshot is None:
+            return
+        tree_path, follow_links, scan_time, directories = self.snapshot
+        prefix = tree_path.rstrip("/") + "/"
+        for path in changed_directories:
+            if path == tree_path:
+                relative_path = ""
+            elif path.startswith(prefix):
+                relative_path = path[len(prefix):]
+            else:
+                # Eg the scanned path was a symlink's referent; the snapshot can't be trusted
+                Cache.remove_snapshot(self.snapshot_path(tree_path, follow_links))
+                return
+            if relative_path in directories:
+                directories[relative_path][0] = None
+        Cache.save_snapshot(self.snapshot_path(tree_path, follow_links), scan_time, directories)
+
     @property
     def sep(self) -> str:
         return "/"
 
     def unlink(self, path: str) -> None:
-        for line in self.adb_shell(["rm", self.escape_path(path)]):
-            self.line_not_captured(line)
+        self.adb_shell_path_command(["rm"], path)
 
     def rmdir(self, path: str) -> None:
-        for line in self.adb_shell(["rm", "-r", self.escape_path(path)]):
-            self.line_not_captured(line)
+        self.adb_shell_path_command(["rm", "-r"], path)
+
+    def rmtree(self, path: str) -> None:
+        self.adb_shell_path_command(["rm", "-r"], path)
 
     def makedirs(self, path: str) -> None:
-        for line in self.adb_shell(["mkdir", "-p", self.escape_path(path)]):
-            self.line_not_captured(line)
+        self.adb_shell_path_command(["mkdir", "-p"], path)
 
     def realpath(self, path: str) -> str:
         for line in self.adb_shell(["realpath", self.escape_path(path)]):
@@ -181,8 +706,18 @@ class AndroidFileSystem(FileSystem):
             # permission error possible?
 
     def lstat(self, path: str) -> os.stat_result:
-        for line in self.adb_shell(["ls", "-lad", self.escape_path(path)]):
-            return self.ls_to_stat(line)[1]
+        if not self.probe_find_printf():
+            for line in self.adb_shell(["ls", "-lad", self.escape_path(path)]):
+                return self.ls_to_stat(line)[1]
+        for record in self.adb_shell(["find", self.escape_path(path), "-maxdepth", "0", "-printf", f"'{self.FIND_PRINTF_FORMAT}'"], separator = "\0"):
+            if find_stat := self.find_to_stat(record):
+                return find_stat[1]
+            elif self.RE_NO_SUCH_FILE.fullmatch(record):
+                raise FileNotFoundError
+            elif self.RE_NOT_A_DIRECTORY.fullmatch(record):
+                raise NotADirectoryError
+            else:
+                self.line_not_captured(record)
 
     def lstat_in_dir(self, path: str) -> Iterable[Tuple[str, os.stat_result]]:
         for line in self.adb_shell(["ls", "-la", self.escape_path(path)]):
@@ -192,10 +727,10 @@ class AndroidFileSystem(FileSystem):
                 yield self.ls_to_stat(line)
 
     def utime(self, path: str, times: Tuple[int, int]) -> None:
-        atime = datetime.datetime.utcfromtimestamp(times[0]).strftime("%Y%m%d%H%M")
-        mtime = datetime.datetime.utcfromtimestamp(times[1]).strftime("%Y%m%d%H%M")
-        for line in self.adb_shell(["touch", "-at", atime, "-mt", mtime, self.escape_path(path)]):
-            self.line_not_captured(line)
+        # Epoch seconds, so neither the device's timezone nor touch -t's minute format get in the way. Only the mtime is
+        # set, which the sync compares: files sharing it then share a touch, whereas atimes are nearly all different
+        _, mtime = times
+        self.adb_shell_path_command(["touch", "-m", "-d", f"@{mtime}"], path)
 
     def join(self, base: str, leaf: str) -> str:
         return os.path.join(base, leaf).replace("\\", "/") # for Windows
@@ -207,7 +742,47 @@ class AndroidFileSystem(FileSystem):
     def normpath(self, path: str) -> str:
         return os.path.normpath(path).replace("\\", "/")
 
-    def push_file_here(self, source: str, destination: str, show_progress: bool = False) -> None:
+    def checksum_files(self, paths: List[str]) -> Dict[str, str]:
+        checksums: Dict[str, str] = {}
+
+        def collect(lines: List[str], exit_status: int) -> None:
+            for line in lines:
+                if match := self.RE_MD5SUM.fullmatch(line):
+                    checksums[match["path"]] = match["checksum"]
+                else:
+                    logging.warning(f"Cannot checksum: {line}")
+
+        with self.pipelined():
+            self.adb_shell_queue_paths(["md5sum"], paths, collect)
+        return checksums
+
+    def adb_shell_queue_paths(self, commands: List[str], paths: List[str], callback: Callable[[List[str], int], None]) -> None:
+        """Queue commands on as many of paths at a time as ARG_MAX allows"""
+        escaped_paths: List[str] = []
+        escaped_paths_size = 0
+        for path in paths:
+            escaped_path = self.escape_path(path)
+            argument_size = len(escaped_path.encode(self.adb_encoding)) + 1
+            if escaped_paths and escaped_paths_size + argument_size > self.argument_size_limit():
+                self.adb_shell_queue(commands + escaped_paths, callback = callback)
+                escaped_paths = []
+                escaped_paths_size = 0
+            escaped_paths.append(escaped_path)
+            escaped_paths_size += argument_size
+        if escaped_paths:
+            self.adb_shell_queue(commands + escaped_paths, callback = callback)
+
+    def push_file_here(self, source: str, destination: str, show_progress: bool = False) -> int:
+        if show_progress:
+            kwargs_call = {}
+        else:
+            kwargs_call = {
+                "stdout": subprocess.DEVNULL,
+                "stderr": subprocess.DEVNULL
+            }
+        return self.adb_call(["push", source, destination], sent_paths = [source], **kwargs_call)
+
+    def push_files_here(self, sources: List[str], destination_directory: str, show_progress: bool = False) -> int:
         if show_progress:
             kwargs_call = {}
         else:
@@ -215,5 +790,152 @@ class AndroidFileSystem(FileSystem):
                 "stdout": subprocess.DEVNULL,
                 "stderr": subprocess.DEVNULL
             }
-        if subprocess.call(self.adb_arguments + ["push", source, destination], **kwargs_call):
-            logging_fatal("Non-zero exit code from adb push")
+        return self.adb_call(["push", *sources, destination_directory], sent_paths = sources, **kwargs_call)
+
+    def probe_tar(self) -> bool:
+        if self.tar_supported is None:
+            self.tar_supported = any(self.adb_shell(["command", "-v", "tar"]))
+        return self.tar_supported
+
+    def can_push_tar_here(self, fs_source: FileSystem) -> bool:
+        return self.probe_tar()
+
+    def probe_compression(self) -> Tuple[Set[str], Set[str]]:
+        """Codecs the device can compress with and decompress with, probed once per session"""
+        if self.compression_codecs is None:
+            tools = set(posixpath.basename(line) for line in self.adb_shell(["for", "tool", "in",
+                *sorted(set(Compression.DEVICE_COMPRESS_COMMANDS[codec][0] for codec in Compression.CODECS) |
+                        set(Compression.DEVICE_DECOMPRESS_COMMANDS[codec][0] for codec in Compression.CODECS)),
+                ";", "do", "command", "-v", "$tool", ";", "done"]))
+            self.compression_codecs = (
+                set(codec for codec in Compression.CODECS if Compression.DEVICE_COMPRESS_COMMANDS[codec][0] in tools),
+                set(codec for codec in Compression.CODECS if Compression.DEVICE_DECOMPRESS_COMMANDS[codec][0] in tools)
+            )
+            logging.debug(f"Device can compress with {sorted(self.compression_codecs[0])} and decompress with {sorted(self.compression_codecs[1])}")
+        return self.compression_codecs
+
+    def tar_compression(self, compression: Optional[str], device_compresses: bool) -> Optional[str]:
+        """The codec to use for tar streams given --compress, or None to send them as they are"""
+        if compression is None:
+            return None
+        available = self.probe_compression()[0 if device_compresses else 1] & set(Compression.host_codecs())
+        if compression == "auto":
+            for codec in Compression.CODECS:
+                if codec in available:
+                    return codec
+            logging.warning("No compression codec shared with the device, sending uncompressed")
+            return None
+        elif compression in available:
+            return compression
+        else:
+            logging.warning(f"Cannot use {compression} with the device, sending uncompressed")
+            return None
+
+    def push_tar_here(self,
+        source_root: str,
+        files: List[Tuple[str, str, TreeLeaf]],
+        destination_root: str,
+        fs_source: FileSystem,
+        transfers: TransferScheduler,
+        show_progress: bool = False,
+        compression: Optional[str] = None
+        ) -> None:
+        codec = self.tar_compression(compression, device_compresses = False)
+        members = [(source, posixpath.relpath(destination, destination_root), times) for source, destination, times in files]
+        if codec is None:
+            member_groups = [(members, None)]
+        else:
+            member_groups = [
+                ([member for member in members if Compression.is_compressible(member[1])], codec),
+                ([member for member in members if not Compression.is_compressible(member[1])], None)
+            ]
+        for group, group_codec in member_groups:
+            if group:
+                unsent: Set[str] = set() # filled in by the transfer
+                transfers.submit(
+                    [arcname for _, arcname, _ in group],
+                    [times.size for _, _, times in group],
+                    functools.partial(self.push_tar_members_here, group, destination_root, unsent, codec = group_codec, show_progress = show_progress),
+                    lambda: None,
+                    functools.partial(self.tar_members_not_extracted, group, destination_root, unsent)
+                )
+
+    def tar_members_not_extracted(self,
+        members: List[Tuple[str, str, TreeLeaf]],
+        destination_root: str,
+        unsent: Set[str],
+        arcnames: List[str]
+        ) -> List[str]:
+        """Which of arcnames, from a tar stream the device's tar failed on, are missing: not sent at all, or not found at the
+        destination with the size and modification time they were sent with. The device can't say which members it
+        extracted before it failed"""
+        times_by_path = {posixpath.join(destination_root, arcname): times for _, arcname, times in members}
+        extracted: Set[str] = set()
+
+        def collect(lines: List[str], exit_status: int) -> None:
+            for line in lines:
+                if (match := self.RE_STAT_SIZE_MTIME.fullmatch(line)) and match["path"] in times_by_path:
+                    times = times_by_path[match["path"]]
+                    if int(match["size"]) == times.size and int(match["mtime"]) == times.mtime:
+                        extracted.add(match["path"])
+
+        sent = [arcname for arcname in arcnames if arcname not in unsent]
+        self.adb_shell_queue_paths(["stat", "-c", "'%s %Y %n'"], [posixpath.join(destination_root, arcname) for arcname in sent], collect)
+        self.adb_shell_flush()
+        return [arcname for arcname in arcnames if posixpath.join(destination_root, arcname) not in extracted]
+
+    def push_tar_members_here(self,
+        members: List[Tuple[str, str, TreeLeaf]],
+        destination_root: str,
+        unsent: Set[str],
+        codec: Optional[str] = None,
+        show_progress: bool = False
+        ) -> TransferResult:
+        """unsent collects the members that couldn't be read, for tar_members_not_extracted"""
+        commands = ["tar", "-xf", "-", "-C", self.escape_path(destination_root)]
+        if codec is not None:
+            commands = Compression.DEVICE_DECOMPRESS_COMMANDS[codec] + ["|"] + commands
+        self.counters.count(subprocesses = 1)
+        start = time.time()
+        proc_tar = subprocess.Popen(
+            self.adb_arguments + ["exec-in"] + commands,
+            stdin = subprocess.PIPE,
+            stdout = None if show_progress else subprocess.DEVNULL,
+            stderr = None if show_progress else subprocess.DEVNULL
+        )
+        stream_broken = False
+        try:
+            with Compression.open_compressed(proc_tar.stdin, codec, "wb") as stream, \
+                tarfile.open(fileobj = stream, mode = "w|", format = tarfile.GNU_FORMAT) as tar:
+                for source, arcname, times in members:
+                    # Gone or unreadable since the scan: skip it, the rest can still go
+                    try:
+                        f = open(source, "rb")
+                    except OSError as e:
+                        perror(source, e)
+                        unsent.add(arcname)
+                        continue
+                    with f:
+                        tarinfo = tar.gettarinfo(arcname = arcname, fileobj = f)
+                        tarinfo.mtime = times.mtime
+                        tarinfo.uid = tarinfo.gid = 0
+                        tarinfo.uname = tarinfo.gname = ""
+                        tar.addfile(tarinfo, f)
+        except BrokenPipeError:
+            pass # the device side gave up; its exit code says so
+        except OSError as e:
+            # Failing halfway through a file (eg it shrank) leaves the stream unusable past it
+            perror(source, e)
+            stream_broken = True
+        finally:
+            try:
+                proc_tar.stdin.close()
+            except BrokenPipeError:
+                pass
+        exit_code = proc_tar.wait()
+        if self.trace is not None:
+            self.trace.subprocess(self.adb_arguments + ["exec-in"] + commands, start, exit_code, sent_paths = [source for source, arcname, _ in members if arcname not in unsent])
+        if exit_code or stream_broken:
+            # Which of them made it is for tar_members_not_extracted to find out
+            return exit_code or 1, [arcname for _, arcname, _ in members]
+        return (1, sorted(unsent)) if unsent else 0
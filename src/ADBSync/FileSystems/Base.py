@@ -1,16 +1,143 @@
 from __future__ import annotations
-from typing import Iterable, List, Tuple, Union
+from typing import AbstractSet, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import os
 import stat
+import subprocess
+import time
 
-from ..SAOLogging import perror
+from ..Excludes import TreeExclude
+from ..SAOLogging import logging_fatal, perror
+from ..Stats import AdbCounters
+from ..Trace import AdbTrace
+
+# What a transfer returns: its exit code, or for transfers of several files that can go through in part (tar streams)
+# the exit code along with the descriptions of the files that didn't
+TransferResult = Union[int, Tuple[int, List[str]]]
+
+class TransferScheduler():
+    """Runs up to jobs file transfers at once. Completion callbacks (eg utime) run on the calling thread,
+    and failed transfers are collected instead of ending the sync. Files that made it are counted in counters"""
+    def __init__(self, jobs: int = 1, counters: Optional[AdbCounters] = None) -> None:
+        self.jobs = jobs
+        self.counters = counters
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = jobs) if jobs > 1 else None
+        self.pending: Dict[concurrent.futures.Future, Tuple[List[str], List[int], Callable[[], None], Optional[Callable[[List[str]], List[str]]]]] = {}
+        self.failures: List[str] = []
+
+    def submit(self,
+        descriptions: List[str],
+        sizes: List[int],
+        transfer: Callable[[], TransferResult],
+        on_success: Callable[[], None],
+        verify: Optional[Callable[[List[str]], List[str]]] = None
+        ) -> None:
+        """sizes are those of the files described. verify, if given, is called on the calling thread with the descriptions
+        of the files that failed, and returns those that really did, eg after looking for them at the destination"""
+        if self.executor is None:
+            self.finish(descriptions, sizes, transfer(), on_success, verify)
+            return
+        while len(self.pending) >= 2 * self.jobs:
+            self.wait(concurrent.futures.FIRST_COMPLETED)
+        self.pending[self.executor.submit(transfer)] = (descriptions, sizes, on_success, verify)
+
+    def wait(self, return_when: str = concurrent.futures.ALL_COMPLETED) -> None:
+        done, _ = concurrent.futures.wait(self.pending, return_when = return_when)
+        for future in done:
+            descriptions, sizes, on_success, verify = self.pending.pop(future)
+            self.finish(descriptions, sizes, future.result(), on_success, verify)
+
+    def finish(self,
+        descriptions: List[str],
+        sizes: List[int],
+        result: TransferResult,
+        on_success: Callable[[], None],
+        verify: Optional[Callable[[List[str]], List[str]]] = None
+        ) -> None:
+        if isinstance(result, tuple):
+            exit_code, failed = result
+        else:
+            exit_code, failed = result, (descriptions if result else [])
+        if failed and verify is not None:
+            failed = verify(failed)
+        if self.counters is not None:
+            failed_set = set(failed)
+            transferred_sizes = [size for description, size in zip(descriptions, sizes) if description not in failed_set]
+            self.counters.count(files_transferred = len(transferred_sizes), bytes_transferred = sum(transferred_sizes))
+        if failed:
+            self.failures.extend(f"{description} (exit code {exit_code})" for description in failed)
+        else:
+            on_success()
+
+    def close(self) -> None:
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+class TreeLeaf(int):
+    """A file in a files tree: atime, mtime and size packed into a single int, but indexed like the (atime, mtime, size)
+    tuple. One object instead of a tuple and three ints is less than half the memory for trees of millions of files"""
+    __slots__ = ()
+    FIELD_BITS = 48
+    FIELD_MASK = (1 << FIELD_BITS) - 1
+    TIME_BIAS = 1 << (FIELD_BITS - 1) # times before 1970 are negative
+
+    def __new__(cls, atime: int, mtime: int, size: int) -> TreeLeaf:
+        return super().__new__(cls,
+            (atime + cls.TIME_BIAS) << (2 * cls.FIELD_BITS) |
+            (mtime + cls.TIME_BIAS) << cls.FIELD_BITS |
+            size
+        )
+
+    @classmethod
+    def from_packed(cls, packed: int) -> TreeLeaf:
+        return int.__new__(cls, packed)
+
+    @property
+    def atime(self) -> int:
+        return (int(self) >> (2 * self.FIELD_BITS)) - self.TIME_BIAS
+
+    @property
+    def mtime(self) -> int:
+        return ((int(self) >> self.FIELD_BITS) & self.FIELD_MASK) - self.TIME_BIAS
+
+    @property
+    def size(self) -> int:
+        return int(self) & self.FIELD_MASK
+
+    def __getitem__(self, index):
+        return (self.atime, self.mtime, self.size)[index]
+
+    def __len__(self) -> int:
+        return 3
+
+    def __iter__(self) -> Iterator[int]:
+        return iter((self.atime, self.mtime, self.size))
+
+    def __repr__(self) -> str:
+        return repr(tuple(self))
+
+    __str__ = __repr__
 
 class FileSystem():
+    TRANSFER_ARGUMENTS_SIZE_LIMIT = 30000 # characters of source paths per adb push / pull, under the Windows command line limit
+
     def __init__(self, adb_arguments: List[str]) -> None:
         self.adb_arguments = adb_arguments
+        self.timestamp_resolution = 1 # seconds, coarser when the listing can't do better
+        self.counters = AdbCounters() # for --stats
+        self.trace: Optional[AdbTrace] = None # for --trace, set by main
 
-    def _get_files_tree(self, tree_path: str, tree_path_stat: os.stat_result, follow_links: bool = False):
+    def _get_files_tree(self,
+        tree_path: str,
+        tree_path_stat: os.stat_result,
+        follow_links: bool = False,
+        exclude: Optional[TreeExclude] = None,
+        names: Tuple[str, ...] = ()
+        ):
         # the reason to have two functions instead of one purely recursive one is to use self.lstat_in_dir ie ls
         # which is much faster than individually stat-ing each file. Hence we have get_files_tree's special first lstat
         if stat.S_ISLNK(tree_path_stat.st_mode):
@@ -24,39 +151,85 @@ class FileSystem():
             except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
                 perror(f"Skipping symlink {tree_path}", e)
                 return None
-            return self._get_files_tree(tree_path_realpath, tree_path_stat_realpath, follow_links = follow_links)
+            return self._get_files_tree(tree_path_realpath, tree_path_stat_realpath, follow_links = follow_links, exclude = exclude, names = names)
         elif stat.S_ISDIR(tree_path_stat.st_mode):
-            tree = {".": (60 * (int(tree_path_stat.st_atime) // 60), 60 * (int(tree_path_stat.st_mtime) // 60))}
+            tree = {".": self.stat_to_tree_leaf(tree_path_stat)}
+            if names and exclude is not None and exclude(names):
+                return tree
             for filename, stat_object_child, in self.lstat_in_dir(tree_path):
                 if filename in [".", ".."]:
                     continue
                 tree[filename] = self._get_files_tree(
                     self.join(tree_path, filename),
                     stat_object_child,
-                    follow_links = follow_links)
+                    follow_links = follow_links,
+                    exclude = exclude,
+                    names = names + (filename,))
             return tree
         elif stat.S_ISREG(tree_path_stat.st_mode):
-            return (60 * (int(tree_path_stat.st_atime) // 60), 60 * (int(tree_path_stat.st_mtime) // 60)) # minute resolution
+            return self.stat_to_tree_leaf(tree_path_stat)
         else:
             raise NotImplementedError
 
-    def get_files_tree(self, tree_path: str, follow_links: bool = False):
+    @staticmethod
+    def stat_to_tree_leaf(stat_object: os.stat_result) -> TreeLeaf:
+        return TreeLeaf(int(stat_object.st_atime), int(stat_object.st_mtime), stat_object.st_size or 0) # ls gives directories no size
+
+    def get_files_tree(self, tree_path: str, follow_links: bool = False, exclude: Optional[TreeExclude] = None):
+        """exclude is called with the names leading from tree_path to each directory below it. Those it returns True for
+        are left unlisted, their trees holding just "." """
         statObject = self.lstat(tree_path)
-        return self._get_files_tree(tree_path, statObject, follow_links = follow_links)
+        return self._get_files_tree(tree_path, statObject, follow_links = follow_links, exclude = exclude)
 
-    def remove_tree(self, tree_path: str, tree: Union[Tuple[int, int], dict], dry_run: bool = True) -> None:
-        if isinstance(tree, tuple):
+    def remove_tree(self, tree_path: str, tree: Union[TreeLeaf, dict], dry_run: bool = True, partial_directories: AbstractSet[int] = frozenset()) -> None:
+        """partial_directories are the ids of the directories of tree that leave out some of their entries (see SyncPlan),
+        which must not go with everything in them"""
+        whole_trees: Set[int] = set()
+        self.find_whole_trees(tree, whole_trees, partial_directories)
+        with self.pipelined():
+            self._remove_tree(tree_path, tree, whole_trees, dry_run = dry_run)
+
+    @classmethod
+    def find_whole_trees(cls, tree: Union[TreeLeaf, dict], whole_trees: Set[int], partial_directories: AbstractSet[int]) -> bool:
+        """Collect the ids of the (sub)trees whose folder and every item below are to be removed"""
+        if isinstance(tree, TreeLeaf):
+            return True
+        elif isinstance(tree, dict):
+            whole = bool(tree.get(".", False)) and id(tree) not in partial_directories
+            for key, value in tree.items():
+                if key != "." and not cls.find_whole_trees(value, whole_trees, partial_directories):
+                    whole = False
+            if whole:
+                whole_trees.add(id(tree))
+            return whole
+        else:
+            raise NotImplementedError
+
+    def _remove_tree(self, tree_path: str, tree: Union[TreeLeaf, dict], whole_trees: Set[int], dry_run: bool = True, log_only: bool = False) -> None:
+        if isinstance(tree, TreeLeaf):
             logging.info(f"Removing {tree_path}")
-            if not dry_run:
+            if not dry_run and not log_only:
                 self.unlink(tree_path)
         elif isinstance(tree, dict):
+            # A folder going away with everything in it takes a single recursive delete;
+            # the items are still walked for logging
+            remove_whole_tree = not log_only and id(tree) in whole_trees
             remove_folder = tree.pop(".", False)
             for key, value in tree.items():
-                self.remove_tree(self.normpath(self.join(tree_path, key)), value, dry_run = dry_run)
+                self._remove_tree(
+                    self.normpath(self.join(tree_path, key)),
+                    value,
+                    whole_trees,
+                    dry_run = dry_run,
+                    log_only = log_only or remove_whole_tree
+                )
             if remove_folder:
                 logging.info(f"Removing folder {tree_path}")
-                if not dry_run:
-                    self.rmdir(tree_path)
+                if not dry_run and not log_only:
+                    if remove_whole_tree:
+                        self.rmtree(tree_path)
+                    else:
+                        self.rmdir(tree_path)
         else:
             raise NotImplementedError
 
@@ -64,42 +237,159 @@ class FileSystem():
         tree_path: str,
         relative_tree_path: str, # for logging paths of files / folders copied relative to the source root / destination root
                                  # nicely instead of repeating the root every time; rsync does this nice logging
-        tree: Union[Tuple[int, int], dict],
+        tree: Union[TreeLeaf, dict],
         destination_root: str,
         fs_source: FileSystem,
         dry_run: bool = True,
-        show_progress: bool = False
+        show_progress: bool = False,
+        jobs: int = 1,
+        transfer_mode: str = "file", # "file" for one adb push / pull per file, "batch" for one per directory (see push_files_here),
+                                     # "tar" for tar streams (see push_tar_here)
+        compression: Optional[str] = None # codec for tar streams, "auto" or one of Compression.CODECS
+        ) -> None:
+        tar_files: Optional[List[Tuple[str, str, TreeLeaf]]] = None
+        if transfer_mode == "tar" and not dry_run and isinstance(tree, dict):
+            if self.can_push_tar_here(fs_source):
+                tar_files = []
+            else:
+                logging.warning("No tar on the device, copying file by file")
+                transfer_mode = "file"
+
+        transfers = TransferScheduler(jobs, self.counters)
+        with self.pipelined():
+            if not dry_run:
+                # Every directory exists before any file is transferred, whichever order the transfers finish in
+                self._make_tree_directories(destination_root, tree)
+                self.flush()
+            self._push_tree_here(
+                tree_path,
+                relative_tree_path,
+                tree,
+                destination_root,
+                fs_source,
+                transfers,
+                dry_run = dry_run,
+                show_progress = show_progress,
+                transfer_mode = transfer_mode,
+                tar_files = tar_files
+            )
+            if tar_files:
+                self.push_tar_here(tree_path, tar_files, destination_root, fs_source, transfers, show_progress = show_progress, compression = compression)
+            transfers.close()
+        if transfers.failures:
+            for failure in transfers.failures:
+                logging.error(f"Failed to copy {failure}")
+            logging_fatal(f"{len(transfers.failures)} file(s) failed to copy")
+
+    def _make_tree_directories(self, destination_root: str, tree: Union[TreeLeaf, dict]) -> None:
+        if isinstance(tree, dict):
+            if "." in tree: # directory needs making
+                self.makedirs(destination_root)
+            for key, value in tree.items():
+                if key != ".":
+                    self._make_tree_directories(self.normpath(self.join(destination_root, key)), value)
+
+    def _push_tree_here(self,
+        tree_path: str,
+        relative_tree_path: str,
+        tree: Union[TreeLeaf, dict],
+        destination_root: str,
+        fs_source: FileSystem,
+        transfers: TransferScheduler,
+        dry_run: bool = True,
+        show_progress: bool = False,
+        transfer_mode: str = "file",
+        tar_files: Optional[List[Tuple[str, str, TreeLeaf]]] = None # collects (source, destination, times) in tar mode
         ) -> None:
-        if isinstance(tree, tuple):
+        if isinstance(tree, TreeLeaf):
             if dry_run:
                 logging.info(f"{relative_tree_path}")
+            elif tar_files is not None:
+                logging.info(f"{relative_tree_path}")
+                tar_files.append((tree_path, destination_root, tree))
             else:
                 if not show_progress:
                     # log this instead of letting adb display output
                     logging.info(f"{relative_tree_path}")
-                self.push_file_here(tree_path, destination_root, show_progress = show_progress)
-                self.utime(destination_root, tree)
+                transfers.submit(
+                    [relative_tree_path],
+                    [tree.size],
+                    functools.partial(self.push_file_here, tree_path, destination_root, show_progress = show_progress),
+                    functools.partial(self.utime, destination_root, tree[:2])
+                )
         elif isinstance(tree, dict):
             try:
-                tree.pop(".") # directory needs making
+                tree.pop(".") # directory needs making, see _make_tree_directories
                 logging.info(f"{relative_tree_path}{self.sep}")
-                if not dry_run:
-                    self.makedirs(destination_root)
             except KeyError:
                 pass
+            group: List[Tuple[str, str, str, TreeLeaf]] = [] # files going into destination_root by one adb invocation
+            group_size = 0
             for key, value in tree.items():
-                self.push_tree_here(
+                if transfer_mode == "batch" and isinstance(value, TreeLeaf) and not dry_run:
+                    source = fs_source.normpath(fs_source.join(tree_path, key))
+                    if group and group_size + len(source) + 1 > self.TRANSFER_ARGUMENTS_SIZE_LIMIT:
+                        self._push_files_group_here(group, destination_root, transfers, show_progress = show_progress)
+                        group, group_size = [], 0
+                    if not show_progress:
+                        logging.info(f"{fs_source.join(relative_tree_path, key)}")
+                    group.append((source, fs_source.join(relative_tree_path, key), self.normpath(self.join(destination_root, key)), value))
+                    group_size += len(source) + 1
+                    continue
+                self._push_tree_here(
                     fs_source.normpath(fs_source.join(tree_path, key)),
                     fs_source.join(relative_tree_path, key),
                     value,
                     self.normpath(self.join(destination_root, key)),
                     fs_source,
+                    transfers,
                     dry_run = dry_run,
-                    show_progress = show_progress
+                    show_progress = show_progress,
+                    transfer_mode = transfer_mode,
+                    tar_files = tar_files
                 )
+            if group:
+                self._push_files_group_here(group, destination_root, transfers, show_progress = show_progress)
         else:
             raise NotImplementedError
 
+    def _push_files_group_here(self,
+        group: List[Tuple[str, str, str, TreeLeaf]],
+        destination_directory: str,
+        transfers: TransferScheduler,
+        show_progress: bool = False
+        ) -> None:
+        def utime_group() -> None:
+            for _, _, destination, times in group:
+                self.utime(destination, times[:2])
+        transfers.submit(
+            [relative_path for _, relative_path, _, _ in group],
+            [times.size for _, _, _, times in group],
+            functools.partial(self.push_files_here, [source for source, _, _, _ in group], destination_directory, show_progress = show_progress),
+            utime_group
+        )
+
+    def adb_call(self, arguments: List[str], sent_paths: Sequence[str] = (), received_paths: Sequence[str] = (), **kwargs_call) -> int:
+        """subprocess.call adb with arguments, counted and traced. sent_paths / received_paths are the local files the
+        transfer reads / writes, for the trace"""
+        self.counters.count(subprocesses = 1)
+        if self.trace is None:
+            return subprocess.call(self.adb_arguments + arguments, **kwargs_call)
+        start = time.time()
+        exit_code = subprocess.call(self.adb_arguments + arguments, **kwargs_call)
+        self.trace.subprocess(self.adb_arguments + arguments, start, exit_code, sent_paths = sent_paths, received_paths = received_paths)
+        return exit_code
+
+    @contextlib.contextmanager
+    def pipelined(self) -> Iterator[None]:
+        """unlink, rmdir, makedirs and utime may be deferred until the outermost pipelined block exits,
+        for file systems where each call is a round trip (see Android.py)"""
+        yield
+
+    def flush(self) -> None:
+        """Wait for whatever pipelined() has deferred so far"""
+        pass
+
     # Abstract methods below implemented in Local.py and Android.py
 
     @property
@@ -112,6 +402,9 @@ class FileSystem():
     def rmdir(self, path: str) -> None:
         raise NotImplementedError
 
+    def rmtree(self, path: str) -> None:
+        raise NotImplementedError
+
     def makedirs(self, path: str) -> None:
         raise NotImplementedError
 
@@ -136,5 +429,32 @@ class FileSystem():
     def normpath(self, path: str) -> str:
         raise NotImplementedError
 
-    def push_file_here(self, source: str, destination: str, show_progress: bool = False) -> None:
+    def checksum_files(self, paths: List[str]) -> Dict[str, str]:
+        """MD5 hex digests of regular files by path. Files that could not be read are left out"""
+        raise NotImplementedError
+
+    def push_file_here(self, source: str, destination: str, show_progress: bool = False) -> int:
+        """Copy source from the other file system to destination here, returning the exit code of adb push / pull.
+        May be called from several threads at once, see TransferScheduler"""
+        raise NotImplementedError
+
+    def push_files_here(self, sources: List[str], destination_directory: str, show_progress: bool = False) -> int:
+        """Like push_file_here for many files going into the same existing directory, in one adb invocation"""
+        raise NotImplementedError
+
+    def can_push_tar_here(self, fs_source: FileSystem) -> bool:
+        raise NotImplementedError
+
+    def push_tar_here(self,
+        source_root: str,
+        files: List[Tuple[str, str, TreeLeaf]],
+        destination_root: str,
+        fs_source: FileSystem,
+        transfers: TransferScheduler,
+        show_progress: bool = False,
+        compression: Optional[str] = None
+        ) -> None:
+        """Copy files, given as (source, destination, times), from below source_root to below destination_root as tar streams
+        submitted to transfers. Times are carried in the archive so no utime is needed.
+        Streams are compressed with compression if the device supports it, leaving out already compressed files"""
         raise NotImplementedError
@@ -0,0 +1,100 @@
+"""On-disk caches: local file checksums for --compare checksum (see Local.py) and device tree snapshots for --incremental (see Android.py)"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from .Base import TreeLeaf
+
+CHECKSUM_CACHE_FILENAME = "checksums.sqlite3"
+CHECKSUM_CACHE_MAX_AGE = 90 * 24 * 60 * 60 # seconds an entry may go unused before it is evicted
+SNAPSHOT_VERSION = 2
+
+def default_cache_dir() -> str:
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "adbsync")
+
+class ChecksumCache():
+    """Checksums by absolute path, valid as long as inode, size and mtime still match the file's current stat"""
+    def __init__(self, cache_dir: str) -> None:
+        os.makedirs(cache_dir, exist_ok = True)
+        self.connection = sqlite3.connect(os.path.join(cache_dir, CHECKSUM_CACHE_FILENAME))
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS checksums (
+            path TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            last_used INTEGER NOT NULL
+        )""")
+        self.now = int(time.time())
+
+    @staticmethod
+    def key(path: str, stat_object: os.stat_result) -> Tuple[str, int, int, int]:
+        return os.path.abspath(path), stat_object.st_ino, stat_object.st_size, stat_object.st_mtime_ns
+
+    def get(self, path: str, stat_object: os.stat_result) -> Optional[str]:
+        key = self.key(path, stat_object)
+        row = self.connection.execute(
+            "SELECT checksum FROM checksums WHERE path = ? AND inode = ? AND size = ? AND mtime_ns = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE checksums SET last_used = ? WHERE path = ?", (self.now, key[0]))
+        return row[0]
+
+    def put_many(self, entries: Iterable[Tuple[str, os.stat_result, str]]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key(path, stat_object) + (checksum, self.now) for path, stat_object, checksum in entries)
+        )
+
+    def close(self) -> None:
+        # Entries of files that were changed are replaced by put_many; those of files gone for good age out here
+        evicted = self.connection.execute("DELETE FROM checksums WHERE last_used < ?", (self.now - CHECKSUM_CACHE_MAX_AGE,)).rowcount
+        if evicted:
+            logging.debug(f"Evicted {evicted} stale checksum cache entries")
+        self.connection.commit()
+        self.connection.close()
+
+def snapshot_path(cache_dir: str, key: List[str]) -> str:
+    """Where the --incremental snapshot of a device tree, identified by key, is kept"""
+    digest = hashlib.sha1("\0".join(key).encode("UTF-8")).hexdigest()
+    return os.path.join(cache_dir, "snapshots", f"{digest}.json")
+
+def load_snapshot(path: str) -> Optional[Tuple[int, Dict[str, list]]]:
+    """The scan time and directories saved by save_snapshot, or None if there is no usable snapshot"""
+    try:
+        with open(path, "r", encoding = "UTF-8") as f:
+            snapshot = json.load(f)
+        if snapshot["version"] != SNAPSHOT_VERSION:
+            return None
+        directories = snapshot["directories"]
+        for directory in directories.values():
+            directory[1] = {filename: None if child is None else TreeLeaf.from_packed(child) for filename, child in directory[1].items()}
+        return snapshot["scan_time"], directories
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, IndexError, AttributeError) as e:
+        logging.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+def save_snapshot(path: str, scan_time: int, directories: Dict[str, list]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    # Write aside and rename so that an interrupted run leaves the previous snapshot in place
+    with open(f"{path}.tmp", "w", encoding = "UTF-8") as f:
+        json.dump({"version": SNAPSHOT_VERSION, "scan_time": scan_time, "directories": directories}, f, separators = (",", ":"))
+    os.replace(f"{path}.tmp", path)
+
+def remove_snapshot(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,58 @@
+"""Compressed tar streams for --transfer tar --compress, see Android.py and Local.py"""
+
+from typing import BinaryIO, Dict, List, Optional
+import gzip
+import posixpath
+
+try:
+    import bz2
+except ImportError: # Python built without bzip2
+    bz2 = None
+try:
+    import lzma
+except ImportError: # Python built without liblzma
+    lzma = None
+
+CODECS = ["gzip", "bzip2", "xz"] # in order of preference for --compress auto; gzip is the cheapest on phone CPUs
+
+# Device side filters. Toybox builds commonly only ship the decompressors for bzip2 and xz
+DEVICE_COMPRESS_COMMANDS: Dict[str, List[str]] = {
+    "gzip": ["gzip", "-c"],
+    "bzip2": ["bzip2", "-c"],
+    "xz": ["xz", "-c"]
+}
+DEVICE_DECOMPRESS_COMMANDS: Dict[str, List[str]] = {
+    "gzip": ["gzip", "-d"],
+    "bzip2": ["bzcat"],
+    "xz": ["xzcat"]
+}
+# Put in front of "tar ... | compressor" so that the pipeline fails when tar does, in shells that can (mksh, bash, toybox
+# sh). Others would exit on the unknown option if it weren't tried in a subshell first
+DEVICE_PIPEFAIL: List[str] = ["(set", "-o", "pipefail)", "2>/dev/null", "&&", "set", "-o", "pipefail", ";"]
+
+# Not worth compressing again
+COMPRESSED_EXTENSIONS = frozenset([
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif", ".avif",
+    ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".3gp",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".apk", ".jar", ".pdf"
+])
+
+def host_codecs() -> List[str]:
+    return [codec for codec in CODECS if codec == "gzip" or (codec == "bzip2" and bz2 is not None) or (codec == "xz" and lzma is not None)]
+
+def is_compressible(path: str) -> bool:
+    return posixpath.splitext(path.replace("\\", "/"))[1].lower() not in COMPRESSED_EXTENSIONS
+
+def open_compressed(fileobj: BinaryIO, codec: Optional[str], mode: str) -> BinaryIO:
+    """Wrap a pipe in codec's (de)compressor, mode being "rb" or "wb". Fast presets: the link is the bottleneck, not the ratio"""
+    if codec is None:
+        return fileobj
+    elif codec == "gzip":
+        return gzip.GzipFile(fileobj = fileobj, mode = mode, compresslevel = 6)
+    elif codec == "bzip2":
+        return bz2.BZ2File(fileobj, mode = mode, compresslevel = 6) if mode == "wb" else bz2.BZ2File(fileobj, mode = mode)
+    elif codec == "xz":
+        return lzma.LZMAFile(fileobj, mode = mode, preset = 1) if mode == "wb" else lzma.LZMAFile(fileobj, mode = mode)
+    else:
+        raise NotImplementedError
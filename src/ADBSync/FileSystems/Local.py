@@ -1,12 +1,48 @@
-from typing import Iterable, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import concurrent.futures
 import os
+import stat
+import shutil
 import subprocess
+import functools
+import hashlib
+import logging
+import posixpath
+import tarfile
+import time
 
-from ..SAOLogging import logging_fatal
+from ..Excludes import TreeExclude
+from ..SAOLogging import perror
 
-from .Base import FileSystem
+from .Base import FileSystem, TransferResult, TransferScheduler, TreeLeaf
+from . import Compression
+from .Cache import ChecksumCache
+
+CHECKSUM_READ_SIZE = 1 << 20
+
+def file_checksum(path: str) -> Optional[str]:
+    # Module level so that ProcessPoolExecutor can pickle it
+    try:
+        with open(path, "rb") as file:
+            checksum = hashlib.md5()
+            buffer = bytearray(CHECKSUM_READ_SIZE)
+            view = memoryview(buffer)
+            while size := file.readinto(buffer):
+                checksum.update(view[:size])
+            return checksum.hexdigest()
+    except OSError as e:
+        logging.warning(f"Cannot checksum {path}: {e}")
+        return None
 
 class LocalFileSystem(FileSystem):
+    SCAN_THREADS = 8 # directories listed at once
+    TAR_DATA_FILTER = hasattr(tarfile, "data_filter") # Python 3.12, and 3.8.17 / 3.9.17 / 3.10.12 / 3.11.4
+
+    def __init__(self, adb_arguments: List[str], checksum_cache: Optional[ChecksumCache] = None) -> None:
+        super().__init__(adb_arguments)
+        self.checksum_cache = checksum_cache
+
     @property
     def sep(self) -> str:
         return os.path.sep
@@ -17,6 +53,9 @@ class LocalFileSystem(FileSystem):
     def rmdir(self, path: str) -> None:
         os.rmdir(path)
 
+    def rmtree(self, path: str) -> None:
+        shutil.rmtree(path)
+
     def makedirs(self, path: str) -> None:
         os.makedirs(path, exist_ok = True)
 
@@ -27,8 +66,74 @@ class LocalFileSystem(FileSystem):
         return os.lstat(path)
 
     def lstat_in_dir(self, path: str) -> Iterable[Tuple[str, os.stat_result]]:
-        for filename in os.listdir(path):
-            yield filename, self.lstat(self.join(path, filename))
+        with os.scandir(path) as entries:
+            for entry in entries:
+                yield entry.name, entry.stat(follow_symlinks = False)
+
+    def _get_files_tree(self,
+        tree_path: str,
+        tree_path_stat: os.stat_result,
+        follow_links: bool = False,
+        exclude: Optional[TreeExclude] = None,
+        names: Tuple[str, ...] = ()
+        ):
+        # Same tree as FileSystem._get_files_tree, but sibling directories are listed concurrently; on network file systems
+        # the walk is bound by round trips rather than by us
+        if not stat.S_ISDIR(tree_path_stat.st_mode):
+            return super()._get_files_tree(tree_path, tree_path_stat, follow_links = follow_links, exclude = exclude, names = names)
+
+        tree = {".": self.stat_to_tree_leaf(tree_path_stat)}
+        # Followed symlinks can lead back to an ancestor of theirs; each directory carries its ancestors' (st_dev, st_ino)
+        ancestors = frozenset([(tree_path_stat.st_dev, tree_path_stat.st_ino)]) if follow_links else None
+        with ThreadPoolExecutor(max_workers = self.SCAN_THREADS) as executor:
+            pending = {executor.submit(self.scan_directory, tree_path, follow_links): (tree, names, tree_path, ancestors)}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    directory_tree, directory_names, directory_path, directory_ancestors = pending.pop(future)
+                    for filename, path, stat_object in future.result():
+                        if stat_object is None:
+                            directory_tree[filename] = None
+                        elif stat.S_ISDIR(stat_object.st_mode):
+                            child_ancestors = None
+                            if directory_ancestors is not None:
+                                directory = (stat_object.st_dev, stat_object.st_ino)
+                                if directory in directory_ancestors:
+                                    logging.warning(f"Skipping {self.join(directory_path, filename)}, a symlink loop")
+                                    directory_tree[filename] = None
+                                    continue
+                                child_ancestors = directory_ancestors | {directory}
+                            directory_tree[filename] = {".": self.stat_to_tree_leaf(stat_object)}
+                            child_names = directory_names + (filename,)
+                            if exclude is None or not exclude(child_names):
+                                pending[executor.submit(self.scan_directory, path, follow_links)] = directory_tree[filename], child_names, path, child_ancestors
+                        elif stat.S_ISREG(stat_object.st_mode):
+                            directory_tree[filename] = self.stat_to_tree_leaf(stat_object)
+                        else:
+                            raise NotImplementedError
+        return tree
+
+    def scan_directory(self, path: str, follow_links: bool) -> List[Tuple[str, str, Optional[os.stat_result]]]:
+        """Entries of a directory as (filename, path, stat), with symlinks resolved like FileSystem._get_files_tree does.
+        The stat is None for symlinks that are ignored or broken"""
+        entries = []
+        for filename, stat_object in self.lstat_in_dir(path):
+            entry_path = self.join(path, filename)
+            if stat.S_ISLNK(stat_object.st_mode):
+                if not follow_links:
+                    logging.warning(f"Ignoring symlink {entry_path}")
+                    stat_object = None
+                else:
+                    logging.debug(f"Following symlink {entry_path}")
+                    try:
+                        link_path = entry_path
+                        entry_path = self.realpath(link_path)
+                        stat_object = self.lstat(entry_path)
+                    except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+                        perror(f"Skipping symlink {link_path}", e)
+                        stat_object = None
+            entries.append((filename, entry_path, stat_object))
+        return entries
 
     def utime(self, path: str, times: Tuple[int, int]) -> None:
         os.utime(path, times)
@@ -42,7 +147,37 @@ class LocalFileSystem(FileSystem):
     def normpath(self, path: str) -> str:
         return os.path.normpath(path)
 
-    def push_file_here(self, source: str, destination: str, show_progress: bool = False) -> None:
+    def checksum_files(self, paths: List[str]) -> Dict[str, str]:
+        checksums: Dict[str, str] = {}
+        stat_objects: Dict[str, os.stat_result] = {}
+        if self.checksum_cache is not None:
+            for path in paths:
+                try:
+                    stat_objects[path] = os.stat(path)
+                except OSError:
+                    continue # file_checksum reports it
+                if (checksum := self.checksum_cache.get(path, stat_objects[path])) is not None:
+                    checksums[path] = checksum
+            logging.debug(f"{len(checksums)} of {len(paths)} checksum(s) found in cache")
+
+        paths_to_hash = [path for path in paths if path not in checksums]
+        if len(paths_to_hash) > 1:
+            with ProcessPoolExecutor() as executor:
+                new_checksums = list(executor.map(file_checksum, paths_to_hash, chunksize = 16))
+        else:
+            new_checksums = [file_checksum(path) for path in paths_to_hash]
+        for path, checksum in zip(paths_to_hash, new_checksums):
+            if checksum is not None:
+                checksums[path] = checksum
+
+        if self.checksum_cache is not None:
+            self.checksum_cache.put_many(
+                (path, stat_objects[path], checksums[path])
+                for path in paths_to_hash if path in checksums and path in stat_objects
+            )
+        return checksums
+
+    def push_file_here(self, source: str, destination: str, show_progress: bool = False) -> int:
         if show_progress:
             kwargs_call = {}
         else:
@@ -50,5 +185,131 @@ class LocalFileSystem(FileSystem):
                 "stdout": subprocess.DEVNULL,
                 "stderr": subprocess.DEVNULL
             }
-        if subprocess.call(self.adb_arguments + ["pull", source, destination], **kwargs_call):
-            logging_fatal("Non-zero exit code from adb pull")
+        return self.adb_call(["pull", source, destination], received_paths = [destination], **kwargs_call)
+
+    def push_files_here(self, sources: List[str], destination_directory: str, show_progress: bool = False) -> int:
+        if show_progress:
+            kwargs_call = {}
+        else:
+            kwargs_call = {
+                "stdout": subprocess.DEVNULL,
+                "stderr": subprocess.DEVNULL
+            }
+        return self.adb_call(
+            ["pull", *sources, destination_directory],
+            received_paths = [os.path.join(destination_directory, posixpath.basename(source)) for source in sources],
+            **kwargs_call
+        )
+
+    def can_push_tar_here(self, fs_source: FileSystem) -> bool:
+        return fs_source.probe_tar()
+
+    def push_tar_here(self,
+        source_root: str,
+        files: List[Tuple[str, str, TreeLeaf]],
+        destination_root: str,
+        fs_source: FileSystem,
+        transfers: TransferScheduler,
+        show_progress: bool = False,
+        compression: Optional[str] = None
+        ) -> None:
+        codec = fs_source.tar_compression(compression, device_compresses = True)
+        arcnames = [posixpath.relpath(source, source_root) for source, _, _ in files]
+        sizes = {arcname: times.size for arcname, (_, _, times) in zip(arcnames, files)}
+        if codec is None:
+            arcname_groups = [(arcnames, None)]
+        else:
+            arcname_groups = [
+                ([arcname for arcname in arcnames if Compression.is_compressible(arcname)], codec),
+                ([arcname for arcname in arcnames if not Compression.is_compressible(arcname)], None)
+            ]
+
+        # The member names go on the device's command line, so split them to fit its ARG_MAX
+        argument_size_limit = fs_source.argument_size_limit() - len(" ".join(
+            Compression.DEVICE_PIPEFAIL + ["tar", "-cf", "-", "-C", fs_source.escape_path(source_root), "|", "xz", "-c"]
+        ))
+        for group, group_codec in arcname_groups:
+            chunk: List[str] = []
+            chunk_size = 0
+            for arcname in group:
+                argument_size = len(fs_source.escape_path(arcname)) + 1
+                if chunk and chunk_size + argument_size > argument_size_limit:
+                    self._submit_tar_chunk(chunk, sizes, source_root, destination_root, fs_source, transfers, codec = group_codec, show_progress = show_progress)
+                    chunk, chunk_size = [], 0
+                chunk.append(arcname)
+                chunk_size += argument_size
+            if chunk:
+                self._submit_tar_chunk(chunk, sizes, source_root, destination_root, fs_source, transfers, codec = group_codec, show_progress = show_progress)
+
+    def _submit_tar_chunk(self,
+        arcnames: List[str],
+        sizes: Dict[str, int],
+        source_root: str,
+        destination_root: str,
+        fs_source: FileSystem,
+        transfers: TransferScheduler,
+        codec: Optional[str] = None,
+        show_progress: bool = False
+        ) -> None:
+        commands = ["tar", "-cf", "-", "-C", fs_source.escape_path(source_root)] + [fs_source.escape_path(arcname) for arcname in arcnames]
+        if codec is not None:
+            # The exit status is the compressor's otherwise. Members tar left out are caught by pull_tar_members_here anyway
+            commands = Compression.DEVICE_PIPEFAIL + commands + ["|"] + Compression.DEVICE_COMPRESS_COMMANDS[codec]
+        transfers.submit(
+            arcnames,
+            [sizes[arcname] for arcname in arcnames],
+            functools.partial(self.pull_tar_members_here, commands, set(arcnames), destination_root, codec = codec, show_progress = show_progress),
+            lambda: None
+        )
+
+    def extract_tar_file(self, tar: tarfile.TarFile, tarinfo: tarfile.TarInfo, destination_root: str) -> bool:
+        """Extract a regular file like the "data" extraction filter would, also where there are no filters"""
+        if self.TAR_DATA_FILTER:
+            tar.extract(tarinfo, destination_root, filter = "data")
+            return True
+        if posixpath.isabs(tarinfo.name) or ".." in tarinfo.name.split("/"):
+            logging.error(f"Not extracting {tarinfo.name} from the device, it would land outside {destination_root}")
+            return False
+        # No owner or permissions from the device, only the modification time
+        tar.extract(tarinfo, destination_root, set_attrs = False)
+        os.utime(os.path.join(destination_root, tarinfo.name), (tarinfo.mtime, tarinfo.mtime))
+        return True
+
+    def pull_tar_members_here(self,
+        commands: List[str],
+        arcnames: Set[str],
+        destination_root: str,
+        codec: Optional[str] = None,
+        show_progress: bool = False
+        ) -> TransferResult:
+        self.counters.count(subprocesses = 1)
+        start = time.time()
+        proc_tar = subprocess.Popen(
+            self.adb_arguments + ["exec-out"] + commands,
+            stdout = subprocess.PIPE,
+            stderr = None if show_progress else subprocess.DEVNULL
+        )
+        extracted: Set[str] = set()
+        exit_code = None
+        try:
+            with Compression.open_compressed(proc_tar.stdout, codec, "rb") as stream, \
+                tarfile.open(fileobj = stream, mode = "r|") as tar:
+                for tarinfo in tar:
+                    # Only what was asked for, and nothing that could land outside destination_root
+                    if tarinfo.isfile() and tarinfo.name in arcnames and self.extract_tar_file(tar, tarinfo, destination_root):
+                        extracted.add(tarinfo.name)
+        except (tarfile.TarError, EOFError, OSError) as e:
+            perror("Bad tar stream from the device", e)
+            proc_tar.kill()
+            proc_tar.wait()
+            exit_code = 1
+        finally:
+            proc_tar.stdout.close()
+        if exit_code is None:
+            exit_code = proc_tar.wait()
+        if self.trace is not None:
+            self.trace.subprocess(self.adb_arguments + ["exec-out"] + commands, start, exit_code,
+                received_paths = [os.path.join(destination_root, arcname) for arcname in extracted])
+        # Members extracted whole are in place whatever happened after them
+        missing = sorted(arcnames - extracted)
+        return (exit_code or 1, missing) if missing else 0
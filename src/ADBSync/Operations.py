@@ -0,0 +1,24 @@
+"""Operations yielded by FileSyncer.diff_operations"""
+
+from typing import NamedTuple, Tuple, Union
+
+from .FileSystems.Base import TreeLeaf
+
+class DiffOperation(NamedTuple):
+    """One step of a sync. names is the path of keys below the source and destination roots, () for the roots themselves.
+    source and destination are the leaves, or the dicts for directories, the operation is about"""
+    kind: str
+    names: Tuple[str, ...]
+    path_source: str
+    path_destination: str
+    source: Union[dict, TreeLeaf, None] = None
+    destination: Union[dict, TreeLeaf, None] = None
+    contains_excluded: bool = False # UNACCOUNTED directories only: whether excluded destination items are below it
+
+    MKDIR = "mkdir" # create directory path_destination. Comes before what goes into it
+    COPY = "copy" # copy file path_source to path_destination
+    DELETE = "delete" # destination file in the way of a copy or mkdir. Comes before them
+    RMDIR = "rmdir" # destination subtree in the way of a copy. Comes before it
+    UNACCOUNTED = "unaccounted" # destination file or directory not in the source, deleted by --del. Directories come after their contents
+    EXCLUDED_SOURCE = "excluded_source" # excluded source file or subtree
+    EXCLUDED_DESTINATION = "excluded_destination" # excluded destination file or subtree, deleted by --delete-excluded
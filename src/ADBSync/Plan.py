@@ -0,0 +1,118 @@
+"""The trees a sync works through, gathered from FileSyncer.diff_operations"""
+
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+from .FileSystems.Base import TreeLeaf
+from .Operations import DiffOperation
+
+class SyncPlan():
+    """Trees shaped like the scanned ones holding only what the operations are about, built in a single pass. As the
+    operations come sorted, so are the trees, each directory's "." ahead of its contents"""
+    def __init__(self) -> None:
+        self.delete: Union[dict, TreeLeaf, None] = None # destination items in the way of copy
+        self.copy: Union[dict, TreeLeaf, None] = None
+        self.excluded_source: Union[dict, TreeLeaf, None] = None
+        self.unaccounted_destination: Union[dict, TreeLeaf, None] = None # not in the source
+        self.unaccounted_destination_non_excluded: Union[dict, TreeLeaf, None] = None # same, less folders excluded items are in
+        self.excluded_destination: Union[dict, TreeLeaf, None] = None
+        # ids of the directories above that leave out entries of the scanned ones, ignored symlinks. Never removed whole
+        self.partial_directories: Set[int] = set()
+        # Per tree, the last directory an item went into; operations mostly come several to a directory
+        self.parents: Dict[str, Tuple[Tuple[str, ...], dict]] = {}
+
+    @classmethod
+    def from_operations(cls, operations: Iterable[DiffOperation]) -> "SyncPlan":
+        plan = cls()
+        for operation in operations:
+            plan.add(operation)
+        return plan
+
+    def add(self, operation: DiffOperation) -> None:
+        kind = operation.kind
+        if kind == DiffOperation.COPY:
+            self.insert("copy", operation.names, operation.source)
+        elif kind == DiffOperation.MKDIR:
+            self.insert("copy", operation.names, {".": operation.source["."]})
+        elif kind == DiffOperation.DELETE:
+            self.insert("delete", operation.names, operation.destination)
+        elif kind == DiffOperation.RMDIR:
+            self.insert("delete", operation.names, self.whole_tree(operation.destination))
+        elif kind == DiffOperation.UNACCOUNTED:
+            if isinstance(operation.destination, dict):
+                # Comes after its contents
+                partial = None in operation.destination.values()
+                directory = self.insert_directory("unaccounted_destination", operation.names, operation.destination["."])
+                if partial:
+                    self.partial_directories.add(id(directory))
+                if not operation.contains_excluded:
+                    directory = self.insert_directory("unaccounted_destination_non_excluded", operation.names, operation.destination["."])
+                    if partial:
+                        self.partial_directories.add(id(directory))
+            else:
+                self.insert("unaccounted_destination", operation.names, operation.destination)
+                self.insert("unaccounted_destination_non_excluded", operation.names, operation.destination)
+        elif kind == DiffOperation.EXCLUDED_SOURCE:
+            self.insert("excluded_source", operation.names, self.whole_tree(operation.source))
+        elif kind == DiffOperation.EXCLUDED_DESTINATION:
+            self.insert("excluded_destination", operation.names, self.whole_tree(operation.destination))
+        else:
+            raise NotImplementedError
+
+    def parent(self, tree_name: str, names: Tuple[str, ...]) -> dict:
+        """The directory of tree_name the item at names goes into, created along with those above it if need be"""
+        parent_names = names[:-1]
+        cached = self.parents.get(tree_name)
+        if cached is not None and cached[0] == parent_names:
+            return cached[1]
+        parent = getattr(self, tree_name)
+        if parent is None:
+            parent = {}
+            setattr(self, tree_name, parent)
+        for name in parent_names:
+            parent = parent.setdefault(name, {})
+        self.parents[tree_name] = parent_names, parent
+        return parent
+
+    def insert(self, tree_name: str, names: Tuple[str, ...], value: Union[dict, TreeLeaf]) -> None:
+        if not names:
+            setattr(self, tree_name, value)
+        else:
+            self.parent(tree_name, names)[names[-1]] = value
+
+    def insert_directory(self, tree_name: str, names: Tuple[str, ...], leaf: TreeLeaf) -> dict:
+        """Add the "." of a directory whose contents may already be in the tree"""
+        if not names:
+            directory = {".": leaf, **(getattr(self, tree_name) or {})}
+            setattr(self, tree_name, directory)
+            return directory
+        parent = self.parent(tree_name, names)
+        directory = parent[names[-1]] = {".": leaf, **parent.get(names[-1], {})}
+        self.parents.pop(tree_name) # in case it pointed into the directory just replaced
+        return directory
+
+    def whole_tree(self, tree: Union[dict, TreeLeaf]) -> Union[dict, TreeLeaf]:
+        """A scanned (sub)tree sorted like the plan, without its ignored symlinks"""
+        if not isinstance(tree, dict):
+            return tree
+        whole_tree = {".": tree["."]}
+        for key in sorted(tree):
+            if key == ".":
+                continue
+            if tree[key] is None:
+                self.partial_directories.add(id(whole_tree))
+            else:
+                whole_tree[key] = self.whole_tree(tree[key])
+        return whole_tree
+
+    def destination_removals(self, delete: bool, delete_excluded: bool) -> List[Tuple[str, Union[dict, TreeLeaf, None]]]:
+        """The trees to remove from the destination, in order, with what to call them, given --del and --delete-excluded"""
+        removals = [("delete tree", self.delete)]
+        if delete_excluded and delete:
+            removals.append(("destination excluded tree", self.excluded_destination))
+            removals.append(("destination unaccounted tree", self.unaccounted_destination))
+        elif delete_excluded:
+            removals.append(("destination excluded tree", self.excluded_destination))
+        elif delete:
+            # Folders that excluded items are in stay, with the items
+            removals.append(("non-excluded-supporting destination unaccounted tree", self.unaccounted_destination_non_excluded))
+        return removals
@@ -65,27 +65,50 @@ def logging_fatal(message, log_stack_info: bool = True, exit_code: int = 1):
     logging.critical("Exiting")
     raise SystemExit(exit_code)
 
-def log_tree(title, tree, finals = None, log_leaves_types = True, logging_level = logging.INFO):
-    """Log tree nicely if it is a dictionary.
-    log_leaves_types can be False to log no leaves, True to log all leaves, or a tuple of types for which to log."""
-    if finals is None:
-        finals = []
-    if not isinstance(tree, dict):
-        logging.log(msg = "{}{}{}".format(
-            "".join([" " if final else "│" for final in finals[:-1]] + ["└" if final else "├" for final in finals[-1:]]),
-            title,
-            ": {}".format(tree) if log_leaves_types is not False and (log_leaves_types is True or isinstance(tree, log_leaves_types)) else ""
-        ), level = logging_level)
-    else:
-        logging.log(msg = "{}{}".format(
-            "".join([" " if final else "│" for final in finals[:-1]] + ["└" if final else "├" for final in finals[-1:]]),
-            title
-        ), level = logging_level)
-        tree_items = list(tree.items())
-        for key, value in tree_items[:-1]:
-            log_tree(key, value, finals = finals + [False], log_leaves_types = log_leaves_types, logging_level = logging_level)
-        for key, value in tree_items[-1:]:
-            log_tree(key, value, finals = finals + [True], log_leaves_types = log_leaves_types, logging_level = logging_level)
+def log_tree(title, tree, log_leaves_types = True, logging_level = logging.INFO, summary = False):
+    """Log tree nicely if it is a dictionary, or with summary just how many files and folders it holds and their size.
+    log_leaves_types can be False to log no leaves, True to log all leaves, or a tuple of types for which to log.
+    Nothing is walked if logging_level is disabled."""
+    root_logger = logging.getLogger()
+    if not root_logger.isEnabledFor(logging_level):
+        return
+    if summary:
+        files, folders, size = tree_totals(tree)
+        root_logger.log(logging_level, f"{title}: {files} file(s), {folders} folder(s), {size} bytes")
+        return
+    # (title, tree, line prefix, prefix of the lines below it)
+    stack = [(title, tree, "", "")]
+    while stack:
+        title, tree, prefix, children_prefix = stack.pop()
+        if not isinstance(tree, dict):
+            if log_leaves_types is not False and (log_leaves_types is True or isinstance(tree, log_leaves_types)):
+                root_logger.log(logging_level, f"{prefix}{title}: {tree}")
+            else:
+                root_logger.log(logging_level, f"{prefix}{title}")
+        else:
+            root_logger.log(logging_level, f"{prefix}{title}")
+            tree_items = list(tree.items())
+            if tree_items:
+                key, value = tree_items[-1]
+                stack.append((key, value, children_prefix + "└", children_prefix + " "))
+                for key, value in reversed(tree_items[:-1]):
+                    stack.append((key, value, children_prefix + "├", children_prefix + "│"))
+
+def tree_totals(tree):
+    """How many files and folders tree holds, and the sum of its files' sizes. Ignored (None) entries are not counted"""
+    files = 0
+    folders = 0
+    size = 0
+    stack = [tree]
+    while stack:
+        tree = stack.pop()
+        if isinstance(tree, dict):
+            folders += 1
+            stack.extend(value for key, value in tree.items() if key != ".")
+        elif tree is not None:
+            files += 1
+            size += getattr(tree, "size", 0)
+    return files, folders, size
 
 # like logging.CRITICAl, logging.DEBUG etc
 FATAL = 60
@@ -0,0 +1,119 @@
+"""--stats: where the time of a sync goes, phase by phase"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+from pathlib import Path
+import contextlib
+import json
+import sys
+import threading
+import time
+
+class AdbCounters():
+    """How much a file system has talked to adb, and the files transferred into it. Transfers count from several threads
+    at once with --jobs"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.shell_round_trips = 0 # writes to the persistent adb shell waited on, each carrying one or more commands
+        self.shell_commands = 0
+        self.subprocesses = 0 # adb processes spawned: the shell, push / pull, exec-in / exec-out
+        self.files_transferred = 0 # that made it, see TransferScheduler
+        self.bytes_transferred = 0
+
+    def count(self,
+        shell_round_trips: int = 0,
+        shell_commands: int = 0,
+        subprocesses: int = 0,
+        files_transferred: int = 0,
+        bytes_transferred: int = 0
+        ) -> None:
+        with self.lock:
+            self.shell_round_trips += shell_round_trips
+            self.shell_commands += shell_commands
+            self.subprocesses += subprocesses
+            self.files_transferred += files_transferred
+            self.bytes_transferred += bytes_transferred
+
+    def totals(self) -> Tuple[int, int, int, int, int]:
+        with self.lock:
+            return self.shell_round_trips, self.shell_commands, self.subprocesses, self.files_transferred, self.bytes_transferred
+
+class PhaseStats():
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.wall_time = 0.0
+        self.shell_round_trips = 0
+        self.shell_commands = 0
+        self.subprocesses = 0
+        self.files = 0 # transferred
+        self.bytes = 0
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Bytes transferred per second, if any were"""
+        if not self.bytes or not self.wall_time:
+            return None
+        return self.bytes / self.wall_time
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "name": self.name,
+            "wall_time": self.wall_time,
+            "adb_shell_round_trips": self.shell_round_trips,
+            "adb_shell_commands": self.shell_commands,
+            "adb_subprocesses": self.subprocesses,
+            "files": self.files,
+            "bytes": self.bytes,
+            "throughput": self.throughput
+        }
+
+class SyncStats():
+    """Wall time and adb traffic of each phase of a sync, taken from the counters of both file systems"""
+    def __init__(self, counters: Iterable[AdbCounters]) -> None:
+        self.counters = list(counters)
+        self.start = time.perf_counter()
+        self.phases: List[PhaseStats] = []
+
+    def totals(self) -> Tuple[int, int, int, int, int]:
+        totals = [counters.totals() for counters in self.counters]
+        return tuple(sum(column) for column in zip(*totals)) # type: ignore
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[PhaseStats]:
+        """Time the block and count the adb traffic and the files transferred during it"""
+        phase = PhaseStats(name)
+        totals_before = self.totals()
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.wall_time = time.perf_counter() - start
+            phase.shell_round_trips, phase.shell_commands, phase.subprocesses, phase.files, phase.bytes = (
+                after - before for before, after in zip(totals_before, self.totals())
+            )
+            self.phases.append(phase)
+
+    def total(self) -> PhaseStats:
+        """The whole run so far, including what came before and between the phases"""
+        total = PhaseStats("total")
+        total.wall_time = time.perf_counter() - self.start
+        total.shell_round_trips, total.shell_commands, total.subprocesses, total.files, total.bytes = self.totals()
+        return total
+
+    def print_report(self, file: TextIO = sys.stderr) -> None:
+        """Printed rather than logged, so that -q doesn't hide what --stats asked for"""
+        print("Stats:", file = file)
+        print(f"{'Phase':<10} {'Time':>9} {'Round trips':>11} {'Commands':>9} {'Processes':>9} {'Files':>7} {'Bytes':>13} {'Throughput':>12}", file = file)
+        for phase in self.phases + [self.total()]:
+            throughput = "" if phase.throughput is None else f"{phase.throughput / 2 ** 20:.2f} MiB/s"
+            print((
+                f"{phase.name:<10} {phase.wall_time:>7.2f} s {phase.shell_round_trips:>11} {phase.shell_commands:>9} {phase.subprocesses:>9} "
+                f"{phase.files:>7} {phase.bytes:>13} {throughput:>12}"
+            ).rstrip(), file = file)
+
+    def write_json(self, path: Union[str, Path]) -> None:
+        with open(path, "w", encoding = "UTF-8") as f:
+            json.dump({
+                "phases": [phase.to_dict() for phase in self.phases],
+                "total": self.total().to_dict()
+            }, f, indent = 4)
+            f.write("\n")
@@ -0,0 +1,76 @@
+"""--trace: a record of everything sent to adb, one JSON object per line"""
+
+from typing import Iterable, List, Optional, Union
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+class AdbTrace():
+    """Records of the commands sent to the persistent adb shell and of the adb processes run for transfers.
+    Times are seconds since the epoch, to line up with the device's logcat; transfers write from several threads with --jobs"""
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.lock = threading.Lock()
+        self.file = open(path, "w", encoding = "UTF-8", buffering = 1) # line buffered, so that a crash loses nothing
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii = False) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def shell_command(self,
+        commands: List[str],
+        start: float,
+        end: float,
+        bytes_out: int,
+        chars_in: int,
+        exit_status: Optional[int],
+        round_trip_commands: int = 1
+        ) -> None:
+        """bytes_out is the command line and its end of command marker as sent; chars_in the output read back, marker
+        included, counted after decoding. round_trip_commands is how many commands were sent in the same write"""
+        self.write({
+            "type": "shell",
+            "command": " ".join(commands),
+            "start": start,
+            "end": end,
+            "duration": end - start,
+            "bytes_out": bytes_out,
+            "chars_in": chars_in,
+            "exit_status": exit_status,
+            "round_trip_commands": round_trip_commands
+        })
+
+    def subprocess(self,
+        arguments: List[str],
+        start: float,
+        exit_status: int,
+        sent_paths: Iterable[str] = (),
+        received_paths: Iterable[str] = ()
+        ) -> None:
+        """An adb process that just exited. Bytes are the sizes of the local files it sent or received"""
+        end = time.time()
+        self.write({
+            "type": "subprocess",
+            "command": arguments,
+            "start": start,
+            "end": end,
+            "duration": end - start,
+            "bytes_out": self.local_size(sent_paths),
+            "bytes_in": self.local_size(received_paths),
+            "exit_status": exit_status
+        })
+
+    @staticmethod
+    def local_size(paths: Iterable[str]) -> int:
+        size = 0
+        for path in paths:
+            try:
+                size += os.lstat(path).st_size
+            except OSError:
+                pass # not received after all
+        return size
+
+    def close(self) -> None:
+        self.file.close()
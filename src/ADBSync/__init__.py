@@ -4,290 +4,216 @@
 
 __version__ = "1.3.1"
 
-from typing import List, Tuple, Union
+from typing import Iterator, List, Optional, Set, Tuple, Union
+import concurrent.futures
 import logging
 import os
 import stat
-import fnmatch
+import gc
+import cProfile
 
-from .argparsing import get_cli_args
+from .argparsing import Args, get_cli_args
 from .SAOLogging import logging_fatal, log_tree, setup_root_logger, perror, FATAL
 
-from .FileSystems.Base import FileSystem
+from .FileSystems.Base import FileSystem, TreeLeaf
 from .FileSystems.Local import LocalFileSystem
 from .FileSystems.Android import AndroidFileSystem
+from .FileSystems.Cache import ChecksumCache, default_cache_dir
+from .Excludes import ExcludeMatcher, TreeExclude
+from .Operations import DiffOperation
+from .Plan import SyncPlan
+from .Stats import SyncStats
+from .Trace import AdbTrace
 
 class FileSyncer():
     @classmethod
-    def diff_trees(cls,
-        source: Union[dict, Tuple[int, int], None],
-        destination: Union[dict, Tuple[int, int], None],
+    def leaf_needs_copy(cls,
+        source: TreeLeaf,
+        destination: TreeLeaf,
+        compare: str,
+        timestamp_resolution: int = 1,
+        checksum_mismatch: bool = False
+        ) -> bool:
+        # Compare mtimes at the coarser resolution of the two sides so a minute-precision listing doesn't always look older
+        source_mtime = source.mtime // timestamp_resolution
+        destination_mtime = destination.mtime // timestamp_resolution
+        if compare == "newer":
+            return source_mtime > destination_mtime
+        elif compare == "size-mtime":
+            return source.size != destination.size or source_mtime != destination_mtime
+        elif compare == "size-only":
+            return source.size != destination.size
+        elif compare == "ignore-existing":
+            return False
+        elif compare == "checksum":
+            return source.size != destination.size or checksum_mismatch
+        else:
+            raise NotImplementedError
+
+    @classmethod
+    def diff_operations(cls,
+        source: Union[dict, TreeLeaf, None],
+        destination: Union[dict, TreeLeaf, None],
         path_source: str,
         path_destination: str,
-        destination_exclude_patterns: List[str],
+        destination_excludes: ExcludeMatcher,
         path_join_function_source,
         path_join_function_destination,
         folder_file_overwrite_error: bool = True,
-        ) -> Tuple[
-            Union[dict, Tuple[int, int], None], # delete
-            Union[dict, Tuple[int, int], None], # copy
-            Union[dict, Tuple[int, int], None], # excluded_source
-            Union[dict, Tuple[int, int], None], # unaccounted_destination
-            Union[dict, Tuple[int, int], None]  # excluded_destination
-        ]:
-
-        exclude = False
-        for destination_exclude_pattern in destination_exclude_patterns:
-            if fnmatch.fnmatch(path_destination, destination_exclude_pattern):
-                exclude = True
-                break
-
-        if source is None:
-            if destination is None:
-                delete = None
-                copy = None
-                excluded_source = None
-                unaccounted_destination = None
-                excluded_destination = None
-            elif isinstance(destination, tuple):
-                if exclude:
-                    delete = None
-                    copy = None
-                    excluded_source = None
-                    unaccounted_destination = None
-                    excluded_destination = destination
+        timestamp_resolution: int = 1,
+        compare: str = "newer",
+        checksum_mismatches: Optional[Set[str]] = None,
+        ) -> Iterator[DiffOperation]:
+        """Merge-join the source and destination trees, yielding the operations of a sync in an order they can be carried
+        out in, names sorted within each directory. Walks the trees with a stack rather than recursion and doesn't modify them"""
+        # Entries are (names, path_source, path_destination, source, destination) still to compare, or directories'
+        # UNACCOUNTED operations waiting for their contents along with the count of excluded destination items before them
+        stack: list = [((), path_source, path_destination, source, destination)]
+        excluded_destination_count = 0
+        while stack:
+            entry = stack.pop()
+            if isinstance(entry[0], DiffOperation):
+                operation, excluded_destination_count_before = entry
+                yield operation._replace(contains_excluded = excluded_destination_count != excluded_destination_count_before)
+                continue
+
+            names, path_source, path_destination, source, destination = entry
+            if destination_excludes.match(path_destination):
+                if source is not None:
+                    yield DiffOperation(DiffOperation.EXCLUDED_SOURCE, names, path_source, path_destination, source = source)
+                if destination is not None:
+                    excluded_destination_count += 1
+                    yield DiffOperation(DiffOperation.EXCLUDED_DESTINATION, names, path_source, path_destination, destination = destination)
+                continue
+
+            if isinstance(source, dict) and isinstance(destination, TreeLeaf) or isinstance(source, TreeLeaf) and isinstance(destination, dict):
+                kinds = ("file", "directory") if isinstance(source, dict) else ("directory", "file")
+                if folder_file_overwrite_error:
+                    logging.critical(f"Refusing to overwrite {kinds[0]} {path_destination} with {kinds[1]} {path_source}")
+                    logging_fatal("Use --force if you are sure!")
                 else:
-                    delete = None
-                    copy = None
-                    excluded_source = None
-                    unaccounted_destination = destination
-                    excluded_destination = None
-            elif isinstance(destination, dict):
-                if exclude:
-                    delete = {".": None}
-                    copy = None
-                    excluded_source = None
-                    unaccounted_destination = {".": None}
-                    excluded_destination = destination
+                    logging.warning(f"Overwriting {kinds[0]} {path_destination} with {kinds[1]} {path_source}")
+
+            if source is None:
+                if isinstance(destination, TreeLeaf):
+                    yield DiffOperation(DiffOperation.UNACCOUNTED, names, path_source, path_destination, destination = destination)
+                elif isinstance(destination, dict):
+                    # Its contents first, then the directory itself
+                    stack.append((DiffOperation(DiffOperation.UNACCOUNTED, names, path_source, path_destination, destination = destination), excluded_destination_count))
+                    cls.push_children(stack, names, path_source, path_destination, None, destination, path_join_function_source, path_join_function_destination)
+                elif destination is not None:
+                    raise NotImplementedError
+
+            elif isinstance(source, TreeLeaf):
+                if destination is None:
+                    yield DiffOperation(DiffOperation.COPY, names, path_source, path_destination, source = source)
+                elif isinstance(destination, TreeLeaf):
+                    checksum_mismatch = checksum_mismatches is not None and path_destination in checksum_mismatches
+                    if cls.leaf_needs_copy(source, destination, compare, timestamp_resolution, checksum_mismatch = checksum_mismatch):
+                        yield DiffOperation(DiffOperation.DELETE, names, path_source, path_destination, destination = destination)
+                        yield DiffOperation(DiffOperation.COPY, names, path_source, path_destination, source = source)
+                elif isinstance(destination, dict):
+                    yield DiffOperation(DiffOperation.RMDIR, names, path_source, path_destination, destination = destination)
+                    yield DiffOperation(DiffOperation.COPY, names, path_source, path_destination, source = source)
                 else:
-                    delete = {".": None}
-                    copy = None
-                    excluded_source = None
-                    unaccounted_destination = {".": destination["."]}
-                    excluded_destination = {".": None}
-                    destination.pop(".")
-                    for key, value in destination.items():
-                        delete[key], _, _, unaccounted_destination[key], excluded_destination[key] = cls.diff_trees(
-                            None,
-                            value,
-                            path_join_function_source(path_source, key),
-                            path_join_function_destination(path_destination, key),
-                            destination_exclude_patterns,
-                            path_join_function_source,
-                            path_join_function_destination,
-                            folder_file_overwrite_error = folder_file_overwrite_error
-                        )
-            else:
-                raise NotImplementedError
-
-        elif isinstance(source, tuple):
-            if destination is None:
-                if exclude:
-                    delete = None
-                    copy = None
-                    excluded_source = source
-                    unaccounted_destination = None
-                    excluded_destination = None
-                else:
-                    delete = None
-                    copy = source
-                    excluded_source = None
-                    unaccounted_destination = None
-                    excluded_destination = None
-            elif isinstance(destination, tuple):
-                if exclude:
-                    delete = None
-                    copy = None
-                    excluded_source = source
-                    unaccounted_destination = None
-                    excluded_destination = destination
+                    raise NotImplementedError
+
+            elif isinstance(source, dict):
+                if destination is None:
+                    yield DiffOperation(DiffOperation.MKDIR, names, path_source, path_destination, source = source)
+                    cls.push_children(stack, names, path_source, path_destination, source, None, path_join_function_source, path_join_function_destination)
+                elif isinstance(destination, TreeLeaf):
+                    yield DiffOperation(DiffOperation.DELETE, names, path_source, path_destination, destination = destination)
+                    yield DiffOperation(DiffOperation.MKDIR, names, path_source, path_destination, source = source)
+                    cls.push_children(stack, names, path_source, path_destination, source, None, path_join_function_source, path_join_function_destination)
+                elif isinstance(destination, dict):
+                    cls.push_children(stack, names, path_source, path_destination, source, destination, path_join_function_source, path_join_function_destination)
                 else:
-                    if source[1] > destination[1]:
-                        delete = destination
-                        copy = source
-                        excluded_source = None
-                        unaccounted_destination = None
-                        excluded_destination = None
-                    else:
-                        delete = None
-                        copy = None
-                        excluded_source = None
-                        unaccounted_destination = None
-                        excluded_destination = None
-            elif isinstance(destination, dict):
-                if exclude:
-                    delete = {".": None}
-                    copy = None
-                    excluded_source = source
-                    unaccounted_destination = {".": None}
-                    excluded_destination = destination
-                else:
-                    delete = destination
-                    copy = source
-                    excluded_source = None
-                    unaccounted_destination = {".": None}
-                    excluded_destination = {".": None}
-                    if folder_file_overwrite_error:
-                        logging.critical(f"Refusing to overwrite directory {path_destination} with file {path_source}")
-                        logging_fatal("Use --force if you are sure!")
-                    else:
-                        logging.warning(f"Overwriting directory {path_destination} with file {path_source}")
-            else:
-                raise NotImplementedError
+                    raise NotImplementedError
 
-        elif isinstance(source, dict):
-            if destination is None:
-                if exclude:
-                    delete = None
-                    copy = {".": None}
-                    excluded_source = source
-                    unaccounted_destination = None
-                    excluded_destination = None
-                else:
-                    delete = None
-                    copy = {".": source["."]}
-                    excluded_source = {".": None}
-                    unaccounted_destination = None
-                    excluded_destination = None
-                    source.pop(".")
-                    for key, value in source.items():
-                        _, copy[key], excluded_source[key], _, _ = cls.diff_trees(
-                            value,
-                            None,
-                            path_join_function_source(path_source, key),
-                            path_join_function_destination(path_destination, key),
-                            destination_exclude_patterns,
-                            path_join_function_source,
-                            path_join_function_destination,
-                            folder_file_overwrite_error = folder_file_overwrite_error
-                        )
-            elif isinstance(destination, tuple):
-                if exclude:
-                    delete = None
-                    copy = {".": None}
-                    excluded_source = source
-                    unaccounted_destination = None
-                    excluded_destination = destination
-                else:
-                    delete = destination
-                    copy = {".": source["."]}
-                    excluded_source = {".": None}
-                    unaccounted_destination = None
-                    excluded_destination = None
-                    source.pop(".")
-                    for key, value in source.items():
-                        _, copy[key], excluded_source[key], _, _ = cls.diff_trees(
-                            value,
-                            None,
-                            path_join_function_source(path_source, key),
-                            path_join_function_destination(path_destination, key),
-                            destination_exclude_patterns,
-                            path_join_function_source,
-                            path_join_function_destination,
-                            folder_file_overwrite_error = folder_file_overwrite_error
-                        )
-                    if folder_file_overwrite_error:
-                        logging.critical(f"Refusing to overwrite file {path_destination} with directory {path_source}")
-                        logging_fatal("Use --force if you are sure!")
-                    else:
-                        logging.warning(f"Overwriting file {path_destination} with directory {path_source}")
-                excluded_destination = None
-            elif isinstance(destination, dict):
-                if exclude:
-                    delete = {".": None}
-                    copy = {".": None}
-                    excluded_source = source
-                    unaccounted_destination = {".": None}
-                    excluded_destination = destination
-                else:
-                    delete = {".": None}
-                    copy = {".": None}
-                    excluded_source = {".": None}
-                    unaccounted_destination = {".": None}
-                    excluded_destination = {".": None}
-                    source.pop(".")
-                    for key, value in source.items():
-                        delete[key], copy[key], excluded_source[key], unaccounted_destination[key], excluded_destination[key] = cls.diff_trees(
-                            value,
-                            destination.pop(key, None),
-                            path_join_function_source(path_source, key),
-                            path_join_function_destination(path_destination, key),
-                            destination_exclude_patterns,
-                            path_join_function_source,
-                            path_join_function_destination,
-                            folder_file_overwrite_error = folder_file_overwrite_error
-                        )
-                    destination.pop(".")
-                    for key, value in destination.items():
-                        delete[key], _, _, unaccounted_destination[key], excluded_destination[key] = cls.diff_trees(
-                            None,
-                            value,
-                            path_join_function_source(path_source, key),
-                            path_join_function_destination(path_destination, key),
-                            destination_exclude_patterns,
-                            path_join_function_source,
-                            path_join_function_destination,
-                            folder_file_overwrite_error = folder_file_overwrite_error
-                        )
             else:
                 raise NotImplementedError
 
+    @staticmethod
+    def push_children(stack: list,
+        names: Tuple[str, ...],
+        path_source: str,
+        path_destination: str,
+        source: Optional[dict],
+        destination: Optional[dict],
+        path_join_function_source,
+        path_join_function_destination
+        ) -> None:
+        """Push the entries of one or two directories onto diff_operations' stack, so that they come off in sorted order"""
+        if source is None:
+            keys = sorted(destination, reverse = True)
+        elif destination is None:
+            keys = sorted(source, reverse = True)
         else:
-            raise NotImplementedError
-
-        return delete, copy, excluded_source, unaccounted_destination, excluded_destination
+            keys = sorted(source.keys() | destination.keys(), reverse = True)
+        for key in keys:
+            if key == ".":
+                continue
+            stack.append((
+                names + (key,),
+                path_join_function_source(path_source, key),
+                path_join_function_destination(path_destination, key),
+                None if source is None else source.get(key),
+                None if destination is None else destination.get(key)
+            ))
 
     @classmethod
-    def remove_excluded_folders_from_unaccounted_tree(cls, unaccounted: Union[dict, Tuple[int, int]], excluded: Union[dict, None]) -> dict:
-        # For when we have --del but not --delete-excluded selected; we do not want to delete unaccounted folders that are the
-        # parent of excluded items. At the point in the program that this function is called at either
-        # 1) unaccounted is a tuple (file) and excluded is None
-        # 2) unaccounted is a dict and excluded is a dict or None
-        # trees passed to this function are already pruned; empty dictionary (sub)trees don't exist
-        if excluded is None:
-            return unaccounted
-        else:
-            unaccounted_non_excluded = {}
-            for unaccounted_key, unaccounted_value in unaccounted.items():
-                if unaccounted_key == ".":
-                    continue
-                unaccounted_non_excluded[unaccounted_key] = cls.remove_excluded_folders_from_unaccounted_tree(
-                    unaccounted_value,
-                    excluded.get(unaccounted_key, None)
-                )
-            return unaccounted_non_excluded
+    def checksum_candidates(cls,
+        source: Union[dict, TreeLeaf, None],
+        destination: Union[dict, TreeLeaf, None],
+        path_source: str,
+        path_destination: str,
+        destination_excludes: ExcludeMatcher,
+        path_join_function_source,
+        path_join_function_destination
+        ) -> Iterator[Tuple[str, str]]:
+        """Paths of files present at both ends with the same size, that is those diff_operations needs checksums for"""
+        if destination_excludes.match(path_destination):
+            return
+        if isinstance(source, TreeLeaf) and isinstance(destination, TreeLeaf):
+            if source.size == destination.size:
+                yield path_source, path_destination
+        elif isinstance(source, dict) and isinstance(destination, dict):
+            for key, value in source.items():
+                if key != "." and key in destination:
+                    yield from cls.checksum_candidates(
+                        value,
+                        destination[key],
+                        path_join_function_source(path_source, key),
+                        path_join_function_destination(path_destination, key),
+                        destination_excludes,
+                        path_join_function_source,
+                        path_join_function_destination
+                    )
 
     @classmethod
-    def prune_tree(cls, tree):
-        """Remove all Nones from a tree. May return None if tree is None however."""
-        if not isinstance(tree, dict):
-            return tree
-        else:
-            return_dict = {}
-            for key, value in tree.items():
-                value_pruned = cls.prune_tree(value)
-                if value_pruned is not None:
-                    return_dict[key] = value_pruned
-            return return_dict or None
+    def checksum_mismatches(cls,
+        fs_source: FileSystem,
+        fs_destination: FileSystem,
+        candidates: List[Tuple[str, str]]
+        ) -> Set[str]:
+        """Destination paths of candidates whose checksums differ or could not be computed"""
+        checksums_source = fs_source.checksum_files([path_source for path_source, _ in candidates])
+        checksums_destination = fs_destination.checksum_files([path_destination for _, path_destination in candidates])
+        mismatches = set()
+        for path_source, path_destination in candidates:
+            checksum_source = checksums_source.get(path_source)
+            if checksum_source is None or checksum_source != checksums_destination.get(path_destination):
+                mismatches.add(path_destination)
+        return mismatches
 
     @classmethod
-    def sort_tree(cls, tree):
-        if not isinstance(tree, dict):
-            return tree
-        return {
-            k: cls.sort_tree(v)
-            for k, v in sorted(tree.items())
-        }
+    def tree_directories(cls, tree_path: str, tree: Union[dict, TreeLeaf, None], path_join_function) -> Iterator[str]:
+        if isinstance(tree, dict):
+            yield tree_path
+            for key, value in tree.items():
+                if key != ".":
+                    yield from cls.tree_directories(path_join_function(tree_path, key), value, path_join_function)
 
     @classmethod
     def paths_to_fixed_destination_paths(cls,
@@ -329,7 +255,16 @@ class FileSyncer():
 
 def main():
     args = get_cli_args(__doc__, __version__)
+    if args.logging_profile is None:
+        sync(args)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(sync, args)
+    finally:
+        profiler.dump_stats(args.logging_profile)
 
+def sync(args: Args):
     setup_root_logger(
         no_color = args.logging_no_color,
         verbosity_level = args.logging_verbosity_verbose,
@@ -346,179 +281,203 @@ def main():
         adb_arguments.append(f"-{option}")
         adb_arguments.append(value)
 
-    fs_android = AndroidFileSystem(adb_arguments, args.adb_encoding)
-    fs_local = LocalFileSystem(adb_arguments)
-
-    try:
-        fs_android.test_connection()
-    except BrokenPipeError:
-        logging_fatal("Connection test failed")
-
-    if args.direction == "push":
-        path_source = args.direction_push_local
-        fs_source = fs_local
-        path_destination = args.direction_push_android
-        fs_destination = fs_android
-    else:
-        path_source = args.direction_pull_android
-        fs_source = fs_android
-        path_destination = args.direction_pull_local
-        fs_destination = fs_local
-
-    path_source, path_destination = FileSyncer.paths_to_fixed_destination_paths(path_source, fs_source, path_destination, fs_destination)
-
-    path_source = fs_source.normpath(path_source)
-    path_destination = fs_destination.normpath(path_destination)
+    cache_dir = args.cache_dir or default_cache_dir()
+    fs_android = AndroidFileSystem(adb_arguments, args.adb_encoding, snapshot_dir = cache_dir if args.incremental else None)
+    checksum_cache = None
+    if args.compare == "checksum" and not args.no_cache:
+        checksum_cache = ChecksumCache(cache_dir)
+    fs_local = LocalFileSystem(adb_arguments, checksum_cache = checksum_cache)
+    stats = SyncStats([fs_android.counters, fs_local.counters])
+    trace = None
+    if args.logging_trace is not None:
+        trace = fs_android.trace = fs_local.trace = AdbTrace(args.logging_trace)
 
     try:
-        files_tree_source = fs_source.get_files_tree(path_source, follow_links = args.copy_links)
-    except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
-        perror(path_source, e, FATAL)
+        try:
+            fs_android.test_connection()
+        except BrokenPipeError:
+            logging_fatal("Connection test failed")
+
+        if args.direction == "push":
+            path_source = args.direction_push_local
+            fs_source = fs_local
+            path_destination = args.direction_push_android
+            fs_destination = fs_android
+        else:
+            path_source = args.direction_pull_android
+            fs_source = fs_android
+            path_destination = args.direction_pull_local
+            fs_destination = fs_local
+
+        path_source, path_destination = FileSyncer.paths_to_fixed_destination_paths(path_source, fs_source, path_destination, fs_destination)
+
+        path_source = fs_source.normpath(path_source)
+        path_destination = fs_destination.normpath(path_destination)
+
+        # Excluded directories needn't be listed unless --delete-excluded is to delete their contents. Both trees are matched
+        # by the destination paths diff_operations will check
+        exclude_scan = TreeExclude(args.exclude, path_destination, fs_destination.join, fs_destination.normpath)
+        exclude_source = exclude_scan if args.exclude else None
+        exclude_destination = exclude_scan if args.exclude and not args.delete_excluded else None
+
+        # The trees are millions of small acyclic objects living until the end. Keep the cyclic garbage collector from
+        # walking them over and over while they are built and diffed, then move them out of its sight
+        gc.disable()
+
+        # One side waits on adb and the other on the local disk, so scan both at once. The two file systems share nothing
+        # and each is only used by its own thread; errors are still reported source first
+        with stats.phase("scan"), concurrent.futures.ThreadPoolExecutor(max_workers = 2) as executor:
+            future_files_tree_source = executor.submit(fs_source.get_files_tree, path_source, follow_links = args.copy_links, exclude = exclude_source)
+            future_files_tree_destination = executor.submit(fs_destination.get_files_tree, path_destination, follow_links = args.copy_links, exclude = exclude_destination)
+
+            try:
+                files_tree_source = future_files_tree_source.result()
+            except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+                perror(path_source, e, FATAL)
+
+            try:
+                files_tree_destination = future_files_tree_destination.result()
+            except FileNotFoundError:
+                files_tree_destination = None
+            except (NotADirectoryError, PermissionError) as e:
+                perror(path_destination, e, FATAL)
+
+        logging.info("Source tree:")
+        if files_tree_source is not None:
+            log_tree(path_source, files_tree_source, summary = args.logging_summary)
+        logging.info("")
 
-    try:
-        files_tree_destination = fs_destination.get_files_tree(path_destination, follow_links = args.copy_links)
-    except FileNotFoundError:
-        files_tree_destination = None
-    except (NotADirectoryError, PermissionError) as e:
-        perror(path_destination, e, FATAL)
-
-    logging.info("Source tree:")
-    if files_tree_source is not None:
-        log_tree(path_source, files_tree_source)
-    logging.info("")
-
-    logging.info("Destination tree:")
-    if files_tree_destination is not None:
-        log_tree(path_destination, files_tree_destination)
-    logging.info("")
-
-    if isinstance(files_tree_source, dict):
-        excludePatterns = [fs_destination.normpath(
-            fs_destination.join(path_destination, exclude)
-        ) for exclude in args.exclude]
-    else:
-        excludePatterns = [fs_destination.normpath(
-            path_destination + exclude
-        ) for exclude in args.exclude]
-    logging.debug("Exclude patterns:")
-    logging.debug(excludePatterns)
-    logging.debug("")
-
-    tree_delete, tree_copy, tree_excluded_source, tree_unaccounted_destination, tree_excluded_destination = FileSyncer.diff_trees(
-        files_tree_source,
-        files_tree_destination,
-        path_source,
-        path_destination,
-        excludePatterns,
-        fs_source.join,
-        fs_destination.join,
-        folder_file_overwrite_error = not args.dry_run and not args.force
-    )
+        logging.info("Destination tree:")
+        if files_tree_destination is not None:
+            log_tree(path_destination, files_tree_destination, summary = args.logging_summary)
+        logging.info("")
 
-    tree_delete                  = FileSyncer.prune_tree(tree_delete)
-    tree_copy                    = FileSyncer.prune_tree(tree_copy)
-    tree_excluded_source         = FileSyncer.prune_tree(tree_excluded_source)
-    tree_unaccounted_destination = FileSyncer.prune_tree(tree_unaccounted_destination)
-    tree_excluded_destination    = FileSyncer.prune_tree(tree_excluded_destination)
-
-    tree_delete                  = FileSyncer.sort_tree(tree_delete)
-    tree_copy                    = FileSyncer.sort_tree(tree_copy)
-    tree_excluded_source         = FileSyncer.sort_tree(tree_excluded_source)
-    tree_unaccounted_destination = FileSyncer.sort_tree(tree_unaccounted_destination)
-    tree_excluded_destination    = FileSyncer.sort_tree(tree_excluded_destination)
-
-    logging.info("Delete tree:")
-    if tree_delete is not None:
-        log_tree(path_destination, tree_delete, log_leaves_types = False)
-    logging.info("")
-
-    logging.info("Copy tree:")
-    if tree_copy is not None:
-        log_tree(f"{path_source} --> {path_destination}", tree_copy, log_leaves_types = False)
-    logging.info("")
-
-    logging.info("Source excluded tree:")
-    if tree_excluded_source is not None:
-        log_tree(path_source, tree_excluded_source, log_leaves_types = False)
-    logging.info("")
-
-    logging.info("Destination unaccounted tree:")
-    if tree_unaccounted_destination is not None:
-        log_tree(path_destination, tree_unaccounted_destination, log_leaves_types = False)
-    logging.info("")
-
-    logging.info("Destination excluded tree:")
-    if tree_excluded_destination is not None:
-        log_tree(path_destination, tree_excluded_destination, log_leaves_types = False)
-    logging.info("")
-
-
-    tree_unaccounted_destination_non_excluded = None
-    if tree_unaccounted_destination is not None:
-        tree_unaccounted_destination_non_excluded = FileSyncer.prune_tree(
-            FileSyncer.remove_excluded_folders_from_unaccounted_tree(
-                tree_unaccounted_destination,
-                tree_excluded_destination
-            )
-        )
-
-    logging.info("Non-excluded-supporting destination unaccounted tree:")
-    if tree_unaccounted_destination_non_excluded is not None:
-        log_tree(path_destination, tree_unaccounted_destination_non_excluded, log_leaves_types = False)
-    logging.info("")
-
-    logging.info("SYNCING")
-    logging.info("")
-
-    if tree_delete is not None:
-        logging.info("Deleting delete tree")
-        fs_destination.remove_tree(path_destination, tree_delete, dry_run = args.dry_run)
-    else:
-        logging.info("Empty delete tree")
-    logging.info("")
-
-    if args.delete_excluded and args.delete:
-        if tree_excluded_destination is not None:
-            logging.info("Deleting destination excluded tree")
-            fs_destination.remove_tree(path_destination, tree_excluded_destination, dry_run = args.dry_run)
+        if isinstance(files_tree_source, dict):
+            excludePatterns = [fs_destination.normpath(
+                fs_destination.join(path_destination, exclude)
+            ) for exclude in args.exclude]
         else:
-            logging.info("Empty destination excluded tree")
+            excludePatterns = [fs_destination.normpath(
+                path_destination + exclude
+            ) for exclude in args.exclude]
+        logging.debug("Exclude patterns:")
+        logging.debug(excludePatterns)
+        logging.debug("")
+        excludes = ExcludeMatcher(excludePatterns)
+
+        checksum_mismatches = None
+        if args.compare == "checksum":
+            checksum_candidates = list(FileSyncer.checksum_candidates(
+                files_tree_source,
+                files_tree_destination,
+                path_source,
+                path_destination,
+                excludes,
+                fs_source.join,
+                fs_destination.join
+            ))
+            logging.info(f"Comparing checksums of {len(checksum_candidates)} file(s)")
+            with stats.phase("checksum"):
+                checksum_mismatches = FileSyncer.checksum_mismatches(fs_source, fs_destination, checksum_candidates)
+            if checksum_cache is not None:
+                checksum_cache.close()
+
+        with stats.phase("diff"):
+            plan = SyncPlan.from_operations(FileSyncer.diff_operations(
+                files_tree_source,
+                files_tree_destination,
+                path_source,
+                path_destination,
+                excludes,
+                fs_source.join,
+                fs_destination.join,
+                folder_file_overwrite_error = not args.dry_run and not args.force,
+                timestamp_resolution = max(fs_source.timestamp_resolution, fs_destination.timestamp_resolution),
+                compare = args.compare,
+                checksum_mismatches = checksum_mismatches
+            ))
+
+        gc.freeze()
+        gc.enable()
+
+        logging.info("Delete tree:")
+        if plan.delete is not None:
+            log_tree(path_destination, plan.delete, log_leaves_types = False, summary = args.logging_summary)
         logging.info("")
-        if tree_unaccounted_destination is not None:
-            logging.info("Deleting destination unaccounted tree")
-            fs_destination.remove_tree(path_destination, tree_unaccounted_destination, dry_run = args.dry_run)
-        else:
-            logging.info("Empty destination unaccounted tree")
+
+        logging.info("Copy tree:")
+        if plan.copy is not None:
+            log_tree(f"{path_source} --> {path_destination}", plan.copy, log_leaves_types = False, summary = args.logging_summary)
         logging.info("")
-    elif args.delete_excluded:
-        if tree_excluded_destination is not None:
-            logging.info("Deleting destination excluded tree")
-            fs_destination.remove_tree(path_destination, tree_excluded_destination, dry_run = args.dry_run)
-        else:
-            logging.info("Empty destination excluded tree")
+
+        logging.info("Source excluded tree:")
+        if plan.excluded_source is not None:
+            log_tree(path_source, plan.excluded_source, log_leaves_types = False, summary = args.logging_summary)
+        logging.info("")
+
+        logging.info("Destination unaccounted tree:")
+        if plan.unaccounted_destination is not None:
+            log_tree(path_destination, plan.unaccounted_destination, log_leaves_types = False, summary = args.logging_summary)
+        logging.info("")
+
+        logging.info("Destination excluded tree:")
+        if plan.excluded_destination is not None:
+            log_tree(path_destination, plan.excluded_destination, log_leaves_types = False, summary = args.logging_summary)
         logging.info("")
-    elif args.delete:
-        if tree_unaccounted_destination_non_excluded is not None:
-            logging.info("Deleting non-excluded-supporting destination unaccounted tree")
-            fs_destination.remove_tree(path_destination, tree_unaccounted_destination_non_excluded, dry_run = args.dry_run)
+
+        logging.info("Non-excluded-supporting destination unaccounted tree:")
+        if plan.unaccounted_destination_non_excluded is not None:
+            log_tree(path_destination, plan.unaccounted_destination_non_excluded, log_leaves_types = False, summary = args.logging_summary)
+        logging.info("")
+
+        logging.info("SYNCING")
+        logging.info("")
+
+        trees_changed_at_destination = [] # for the --incremental snapshot
+        with stats.phase("delete"):
+            for description, tree in plan.destination_removals(args.delete, args.delete_excluded):
+                if tree is not None:
+                    logging.info(f"Deleting {description}")
+                    fs_destination.remove_tree(path_destination, tree, dry_run = args.dry_run, partial_directories = plan.partial_directories)
+                    trees_changed_at_destination.append(tree)
+                else:
+                    logging.info(f"Empty {description}")
+                logging.info("")
+
+        if plan.copy is not None:
+            logging.info("Copying copy tree")
+            with stats.phase("transfer"):
+                fs_destination.push_tree_here(
+                    path_source,
+                    fs_destination.split(path_source)[1] if isinstance(plan.copy, TreeLeaf) else ".",
+                    plan.copy,
+                    path_destination,
+                    fs_source,
+                    dry_run = args.dry_run,
+                    show_progress = args.show_progress,
+                    jobs = args.jobs,
+                    transfer_mode = args.transfer,
+                    compression = args.compress
+                )
+            trees_changed_at_destination.append(plan.copy)
         else:
-            logging.info("Empty non-excluded-supporting destination unaccounted tree")
+            logging.info("Empty copy tree")
         logging.info("")
 
-    if tree_copy is not None:
-        logging.info("Copying copy tree")
-        fs_destination.push_tree_here(
-            path_source,
-            fs_destination.split(path_source)[1] if isinstance(tree_copy, tuple) else ".",
-            tree_copy,
-            path_destination,
-            fs_source,
-            dry_run = args.dry_run,
-            show_progress = args.show_progress
-        )
-    else:
-        logging.info("Empty copy tree")
-    logging.info("")
+        if args.incremental:
+            with stats.phase("snapshot"):
+                changed_directories = []
+                if fs_destination is fs_android and not args.dry_run:
+                    for tree in trees_changed_at_destination:
+                        changed_directories.extend(FileSyncer.tree_directories(path_destination, tree, fs_destination.join))
+                fs_android.save_snapshot(changed_directories)
+    finally:
+        if args.logging_stats:
+            stats.print_report()
+        if args.logging_stats_json is not None:
+            stats.write_json(args.logging_stats_json)
+        if trace is not None:
+            trace.close()
 
 if __name__ == "__main__":
     main()
@@ -8,6 +8,11 @@ class Args():
     logging_no_color: bool
     logging_verbosity_verbose: int
     logging_verbosity_quiet: int
+    logging_summary: bool
+    logging_stats: bool
+    logging_stats_json: Optional[Path]
+    logging_trace: Optional[Path]
+    logging_profile: Optional[Path]
 
     dry_run: bool
     copy_links: bool
@@ -17,6 +22,13 @@ class Args():
     delete_excluded: bool
     force: bool
     show_progress: bool
+    jobs: int
+    transfer: str
+    compress: Optional[str]
+    compare: str
+    cache_dir: Optional[str]
+    no_cache: bool
+    incremental: bool
     adb_encoding: str
 
     adb_bin: str
@@ -57,6 +69,37 @@ def get_cli_args(docstring: str, version: str) -> Args:
         dest = "logging_verbosity_quiet",
         default = 0
     )
+    parser_logging.add_argument("--summary",
+        help = "Log how many files and folders each tree holds and their total size instead of listing them",
+        action = "store_true",
+        dest = "logging_summary"
+    )
+    parser_logging.add_argument("--stats",
+        help = "Print the time taken by scanning, diffing, deleting and copying, with adb shell round trips and adb processes spawned during each, and files and bytes copied",
+        action = "store_true",
+        dest = "logging_stats"
+    )
+    parser_logging.add_argument("--stats-json",
+        help = "Write what --stats prints to STATS_JSON as JSON",
+        metavar = "STATS_JSON",
+        type = Path,
+        dest = "logging_stats_json",
+        default = None
+    )
+    parser_logging.add_argument("--trace",
+        help = "Write every command sent to the adb shell and every adb process run for a transfer to TRACE, one JSON object per line, with start and end times, bytes sent and received and exit status",
+        metavar = "TRACE",
+        type = Path,
+        dest = "logging_trace",
+        default = None
+    )
+    parser_logging.add_argument("--profile",
+        help = "Run the sync under cProfile and dump its stats to PROFILE, to be read with 'python3 -m pstats PROFILE'",
+        metavar = "PROFILE",
+        type = Path,
+        dest = "logging_profile",
+        default = None
+    )
 
     parser.add_argument("-n", "--dry-run",
         help = "Perform a dry run; do not actually copy and delete etc",
@@ -102,6 +145,54 @@ def get_cli_args(docstring: str, version: str) -> Args:
         action = "store_true",
         dest = "show_progress"
     )
+    parser.add_argument("-j", "--jobs",
+        help = "Run up to JOBS 'adb push' / 'adb pull' transfers at once. Defaults to 1",
+        metavar = "JOBS",
+        type = int,
+        dest = "jobs",
+        default = 1
+    )
+    parser.add_argument("--transfer",
+        help = "How to transfer files: 'file' runs one 'adb push' / 'adb pull' per file, 'batch' one per destination directory with many sources, 'tar' streams tar archives through 'adb exec-in' / 'adb exec-out' (falls back to file if the device has no tar). Defaults to file",
+        choices = ["file", "batch", "tar"],
+        dest = "transfer",
+        default = "file"
+    )
+    parser.add_argument("--compress",
+        help = "Compress tar streams of --transfer tar with CODEC, or the first one the device supports with 'auto'. Already compressed files (jpg, mp4, zip...) are sent as they are",
+        metavar = "CODEC",
+        choices = ["auto", "gzip", "bzip2", "xz"],
+        dest = "compress",
+        default = None
+    )
+    parser.add_argument("--compare",
+        help = "When to copy a file that exists on both sides: 'newer' if the source mtime is newer, 'size-mtime' if size or mtime differ, 'size-only' if size differs, 'checksum' if size or MD5 checksum differ, 'ignore-existing' never. Defaults to newer",
+        choices = ["newer", "size-mtime", "size-only", "checksum", "ignore-existing"],
+        dest = "compare",
+        default = "newer"
+    )
+    parser.add_argument("-c", "--checksum",
+        help = "Same as --compare checksum, for when modification times can't be trusted",
+        action = "store_const",
+        const = "checksum",
+        dest = "compare"
+    )
+    parser.add_argument("--cache-dir",
+        help = "Where to keep the checksums of local files for --checksum and the device tree snapshots for --incremental. Defaults to adbsync in the user's cache directory",
+        metavar = "CACHE_DIR",
+        dest = "cache_dir",
+        default = None
+    )
+    parser.add_argument("--no-cache",
+        help = "Do not read or write the cache in --cache-dir",
+        action = "store_true",
+        dest = "no_cache"
+    )
+    parser.add_argument("--incremental",
+        help = "Keep a snapshot of the device tree in --cache-dir after each run and only list the directories that changed since on the next",
+        action = "store_true",
+        dest = "incremental"
+    )
     parser.add_argument("--adb-encoding",
         help = "Which encoding to use when talking to adb. Defaults to UTF-8. Relevant to GitHub issue #22",
         dest = "adb_encoding",
@@ -162,6 +253,13 @@ def get_cli_args(docstring: str, version: str) -> Args:
 
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.compress is not None and args.transfer != "tar":
+        parser.error("--compress needs --transfer tar")
+    if args.incremental and args.no_cache:
+        parser.error("--incremental needs the cache, it can't be used with --no-cache")
+
     if args.direction == "push":
         args_direction_ = (
             args.direction_push_local,
@@ -181,6 +279,11 @@ def get_cli_args(docstring: str, version: str) -> Args:
         args.logging_no_color,
         args.logging_verbosity_verbose,
         args.logging_verbosity_quiet,
+        args.logging_summary,
+        args.logging_stats,
+        args.logging_stats_json,
+        args.logging_trace,
+        args.logging_profile,
 
         args.dry_run,
         args.copy_links,
@@ -190,6 +293,13 @@ def get_cli_args(docstring: str, version: str) -> Args:
         args.delete_excluded,
         args.force,
         args.show_progress,
+        args.jobs,
+        args.transfer,
+        args.compress,
+        args.compare,
+        args.cache_dir,
+        args.no_cache,
+        args.incremental,
         args.adb_encoding,
 
         args.adb_bin,